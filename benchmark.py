@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+"""Benchmark MotionVectorReader.analyse() offline, on recorded motion vector
+archives (see MotionVectorReader.save_motion_vectors) or synthetic scenes, and
+report per-frame latency percentiles against the frame budget.
+
+  python3 benchmark.py                      # all synthetic scenarios
+  python3 benchmark.py --scenario busy --fps 15
+  python3 benchmark.py motion_vectors/       # every archive file in there
+  python3 benchmark.py recording.mkv       # MVs decoded in software
+  python3 benchmark.py --threaded --speed 1  # callback latency of the ring buffer
+"""
+
+import os
+import argparse
+import logging
+import numpy as np
+import motion_replay
+import motion_mask
+
+
+def frame_sources(args):
+  """Yields (name, list of MV arrays) for every dump or scenario requested.
+  Frames are loaded into memory up front so that file I/O isn't measured."""
+  for file in args.dumps:
+    yield os.path.basename(file), [a for _, a in motion_replay.read_frames(file)]
+  for name in args.scenario or ([] if args.dumps else sorted(motion_replay.scenarios)):
+    yield name, list(motion_replay.synthetic_motion_vectors(
+        width=args.width, height=args.height, frames=args.count,
+        **motion_replay.scenarios[name]))
+
+
+def report(name, replay, budget):
+  ms = replay.latencies * 1000
+  p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+  overruns = int(np.count_nonzero(ms > budget))
+  print("{0:<24} {1:>6} {2:>8.2f} {3:>8.2f} {4:>8.2f} {5:>8.2f} {6:>6.0f}% {7:>8} {8:>8} {9:>8}".format(
+      name, len(ms), p50, p90, p99, ms.max(), 100 * p99 / budget, overruns,
+      len(replay.triggers), replay.dropped))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('dumps', nargs='*',
+                      help="motion vector archives or directories of them, legacy dumps or H.264 recordings")
+  parser.add_argument('--scenario', action='append', choices=sorted(motion_replay.scenarios),
+                      help="synthetic scenario to replay, may be repeated")
+  parser.add_argument('--count', type=int, default=300, help="frames per synthetic scenario")
+  parser.add_argument('--width', type=int, default=int(os.getenv('PYCAM_WIDTH', 1640)))
+  parser.add_argument('--height', type=int, default=int(os.getenv('PYCAM_HEIGHT', 1232)))
+  parser.add_argument('--fps', type=int, default=int(os.getenv('PYCAM_FPS_MAX', 10)),
+                      help="frame rate defining the per-frame budget")
+  parser.add_argument('--area', type=int, default=int(os.getenv('PYCAM_DETECT_BLOCKS', 25)))
+  parser.add_argument('--frames', type=int, default=int(os.getenv('PYCAM_DETECT_FRAMES', 4)))
+  parser.add_argument('--window', type=int,
+                      default=int(os.getenv('PYCAM_POSTBUFFER_SEC', 5)) * int(os.getenv('PYCAM_FPS_MAX', 10)))
+  parser.add_argument('--repeat', type=int, default=1, help="replay every source this often")
+  parser.add_argument('--threaded', action='store_true',
+                      help="analyse on a worker thread, measuring the camera callback only")
+  parser.add_argument('--speed', type=float,
+                      help="pace frames at this multiple of the frame rate instead of full speed")
+  parser.add_argument('--adaptive', action='store_true',
+                      help="let the reader shed load when analysis exceeds its budget")
+  parser.add_argument('--mask', default=os.getenv('PYCAM_DETECT_MASK') or None,
+                      help="region of interest mask, an image or .npy file (see motion_mask)")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING)
+
+  budget = 1000 / args.fps
+  print("frame budget {0:.1f} ms at {1} fps".format(budget, args.fps))
+  print("{0:<24} {1:>6} {2:>8} {3:>8} {4:>8} {5:>8} {6:>7} {7:>8} {8:>8} {9:>8}".format(
+      'source', 'frames', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'p99/b', 'overruns', 'triggers',
+      'dropped'))
+  for name, frames in frame_sources(args):
+    if not frames:
+      continue
+    weights = None
+    if args.mask:
+      weights = motion_mask.load_mask(args.mask, motion_replay.grid_resolution(frames[0].shape))
+    for _ in range(args.repeat):
+      motion = motion_replay.replay_reader(frames[0].shape, framerate=args.fps,
+                                           window=args.window, area=args.area, frames=args.frames,
+                                           threaded=args.threaded, adaptive=args.adaptive,
+                                           weights=weights)
+      report(name, motion_replay.replay(motion, frames, args.speed), budget)
+      motion.stop()
+
+
+if __name__ == '__main__':
+  main()
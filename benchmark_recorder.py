@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+"""Benchmark the whole recording pipeline end to end on the simulated camera:
+motion detection, circular buffer snapshots, muxing and spooling for upload.
+Reports events per hour of camera time, the latency from the motion trigger
+to the finished recording and from the end of motion to it, and the longest
+circular buffer lock per recording.
+
+  python3 benchmark_recorder.py --speed 10 --duration 600
+  python3 benchmark_recorder.py --video clip.h264 --motion motion-vectors.dat
+  python3 benchmark_recorder.py --motion busy --upload-delay 2
+"""
+
+import os
+import time
+import shutil
+import argparse
+import logging
+import tempfile
+import threading
+import numpy as np
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--video', default='', help="H.264 Annex B file to play back, looped")
+  parser.add_argument('--motion', default='visitor',
+                      help="motion vector dump or synthetic scenario to play back, looped. "
+                      "A scenario must stay still for longer than the window for motion to end")
+  parser.add_argument('--speed', type=float, default=10.0, help="multiple of real time")
+  parser.add_argument('--duration', type=float, default=600.0, help="seconds of camera time")
+  parser.add_argument('--upload-delay', type=float, default=0.0,
+                      help="seconds each simulated upload of a recording takes")
+  parser.add_argument('--keep', help="keep recordings in this directory (faster than real time, "
+                      "recordings named after the same second overwrite each other)")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING)
+
+  # the camera backend and its source are picked up when the recorder is imported
+  os.environ['PYCAM_CAMERA'] = 'simulated'
+  os.environ['PYCAM_SIM_VIDEO'] = args.video
+  os.environ['PYCAM_SIM_MOTION'] = args.motion
+  os.environ['PYCAM_SIM_SPEED'] = str(args.speed)
+  from motion_recorder import MotionRecorder
+  import motion_replay
+
+  directory = args.keep or tempfile.mkdtemp(prefix='pycam-')
+  MotionRecorder.video_dir = os.path.join(directory, 'videos')
+  MotionRecorder.image_dir = os.path.join(directory, 'images')
+  MotionRecorder.event_db = os.path.join(directory, 'events.db')
+  MotionRecorder.preroll_path = os.path.join(directory, 'preroll.ring')
+  os.makedirs(MotionRecorder.video_dir, exist_ok=True)
+  os.makedirs(MotionRecorder.image_dir, exist_ok=True)
+
+  recorder = MotionRecorder()
+  window = recorder.postbuffer * recorder.framerate_max
+  scenario = motion_replay.scenarios.get(args.motion)
+  if scenario and scenario.get('objects') and scenario['period'] <= window:
+    logging.warning("'{0}' is still for {1} frames, no longer than the window of {2}: "
+                    "motion may never end".format(args.motion, scenario['period'], window))
+  triggers = []  # wall time when motion was detected, and when it ended
+  recordings = []  # (wall time the recording was spooled, longest buffer lock)
+  put = recorder.captures.put
+
+  def spooled(path):
+    put(path)
+    recordings.append((time.perf_counter(), recorder.lock_time))
+  recorder.captures.put = spooled
+
+  def watch_trigger(motion):
+    while recorder._camera.recording:
+      if motion.wait(0.1):
+        triggers.append([time.perf_counter(), None])
+        while motion.motion() and recorder._camera.recording:
+          time.sleep(0.001)
+        triggers[-1][1] = time.perf_counter()
+
+  def upload(captures):
+    while True:
+      path = captures.get()
+      time.sleep(args.upload_delay)
+      if not args.keep:
+        captures.done(path)
+
+  start = time.perf_counter()
+  with recorder:
+    threading.Thread(name="watch trigger", target=watch_trigger, args=(recorder._motion,),
+                     daemon=True).start()
+    threading.Thread(name="upload", target=upload, args=(recorder.captures,), daemon=True).start()
+    recorder.start()
+    recorder._camera.wait_recording(args.duration)
+    recorder._camera.stop_recording()
+    recorder.join()
+  wall = time.perf_counter() - start
+  backlog = recorder.captures.qsize()
+  indexed = len(recorder.events.events(0))
+  if not args.keep:
+    shutil.rmtree(directory)
+
+  # every recording starts at the first trigger after the previous one was spooled
+  trigger_to_file, end_to_file = [], []
+  previous = 0.0
+  for spooled_at, _ in recordings:
+    within = [t for t in triggers if previous <= t[0] < spooled_at]
+    if within:
+      trigger_to_file.append(spooled_at - within[0][0])
+      if within[-1][1] is not None:
+        end_to_file.append(spooled_at - within[-1][1])
+    previous = spooled_at
+
+  def ms(values):
+    if not values:
+      return "-"
+    p50, p99 = np.percentile(1000 * np.array(values), [50, 99])
+    return "p50 {0:.0f} ms, p99 {1:.0f} ms, max {2:.0f} ms".format(p50, p99, 1000 * max(values))
+
+  print("{0:.0f} s of camera time in {1:.1f} s at {2:g}x, latencies in wall time".format(
+      args.duration, wall, args.speed))
+  print("events:            {0} ({1:.1f} per hour)".format(
+      len(recordings), len(recordings) * 3600 / args.duration))
+  print("indexed events:    {0}".format(indexed))
+  print("trigger to file:   " + ms(trigger_to_file))
+  print("end to file:       " + ms(end_to_file))
+  print("buffer lock:       " + ms([lock for _, lock in recordings]))
+  print("written:           " + str(recorder._writer))
+  print("upload backlog:    {0} recordings".format(backlog))
+
+
+if __name__ == '__main__':
+  main()
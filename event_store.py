@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+"""Local index of motion events and per-second motion statistics, in SQLite.
+
+  python3 event_store.py              # events of the last 7 days
+  python3 event_store.py --days 1 --series
+"""
+
+import os
+import time
+import queue
+import sqlite3
+import logging
+import argparse
+import threading
+import metrics
+
+writes_total = metrics.counter('pycam_event_store_writes_total', 'Statements written to the event store')
+commit_seconds = metrics.histogram('pycam_event_store_commit_seconds', 'Time to commit a batch to the event store')
+
+schema = """
+CREATE TABLE IF NOT EXISTS events (
+  path TEXT PRIMARY KEY,  -- the recording
+  start REAL NOT NULL,  -- seconds since the epoch
+  end REAL,
+  trigger_frame INTEGER,  -- camera frame index at which motion was detected
+  peak_area INTEGER,  -- largest area of motion in MV blocks, until the end
+  mean_area REAL,  -- mean largest area in frames with motion
+  exposure_speed INTEGER,  -- us
+  analog_gain REAL,
+  digital_gain REAL,
+  upload TEXT NOT NULL DEFAULT 'pending',  -- pending, uploaded or failed
+  attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS events_start ON events (start);
+CREATE INDEX IF NOT EXISTS events_upload ON events (upload) WHERE upload != 'uploaded';
+CREATE TABLE IF NOT EXISTS motion (
+  second INTEGER PRIMARY KEY,  -- seconds since the epoch
+  frames INTEGER NOT NULL,  -- frames analysed
+  moving REAL NOT NULL,  -- mean number of MV blocks above the noise field
+  largest INTEGER NOT NULL,  -- largest area of motion in MV blocks
+  motion_frames INTEGER NOT NULL  -- frames with an area of motion of the minimum size
+);
+"""
+
+
+class EventStore(threading.Thread):
+  """Background thread owning the SQLite database of motion events and motion
+  statistics. Writes are queued and committed in batches, at most every
+  interval seconds, to a database in WAL mode, so that neither the recorder nor
+  the motion analysis ever wait for the SD card, and readers never block the
+  writer.
+  """
+
+  prune_interval = 3600  # seconds between deleting old motion statistics
+
+  def __init__(self, path, interval=5.0, days=30):
+    """Initialize event store
+
+    Parameters
+    ----------
+    path : SQLite database file
+    interval : seconds to collect writes into one transaction
+    days : days of per-second motion statistics to keep, events are kept forever
+    """
+    super().__init__(name="event store", daemon=True)
+    self.path = path
+    self.interval = interval
+    self.days = days
+    self._queue = queue.Queue()
+    self._db = self._connect()
+    self._db.executescript(schema)
+
+  def _connect(self):
+    db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')  # durable at checkpoints, enough for an index
+    return db
+
+  def submit(self, sql, params=()):
+    """Queue a statement for the next batch."""
+    self._queue.put((sql, params))
+
+  def flush(self):
+    """Wait until all submitted statements are committed."""
+    done = threading.Event()
+    self._queue.put((None, done))
+    done.wait()
+
+  def close(self):
+    """Commit what is queued and stop the thread."""
+    if self.is_alive():
+      self._queue.put(None)
+      self.join()
+    self._db.close()
+
+  def run(self):
+    pruned = 0.0
+    while True:
+      batch = [self._queue.get()]
+      deadline = time.monotonic() + self.interval
+      # collect everything submitted until the deadline, or until asked to flush
+      while batch[-1] is not None and batch[-1][0] is not None:
+        try:
+          batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+        except queue.Empty:
+          break
+      statements = [item for item in batch if item is not None and item[0] is not None]
+      if time.monotonic() - pruned > self.prune_interval:
+        pruned = time.monotonic()
+        statements.append(('DELETE FROM motion WHERE second < ?', (int(time.time()) - self.days * 86400,)))
+      try:
+        start = time.perf_counter()
+        with self._db:
+          for sql, params in statements:
+            self._db.execute(sql, params)
+        commit_seconds.observe(time.perf_counter() - start)
+        writes_total.inc(len(statements))
+      except sqlite3.Error as e:
+        logging.error("while writing to the event store: {0}".format(e))
+      for item in batch:
+        if item is not None and item[0] is None:
+          item[1].set()
+      if batch[-1] is None:
+        return
+
+  def start_event(self, path, start, trigger_frame=None, exposure_speed=None, analog_gain=None,
+                  digital_gain=None):
+    self.submit('INSERT OR REPLACE INTO events (path, start, trigger_frame, exposure_speed, '
+                'analog_gain, digital_gain) VALUES (?, ?, ?, ?, ?, ?)',
+                (path, start, None if trigger_frame is None else int(trigger_frame), exposure_speed,
+                 None if analog_gain is None else float(analog_gain),
+                 None if digital_gain is None else float(digital_gain)))
+
+  def end_event(self, path, end, peak_area=None, mean_area=None):
+    self.submit('UPDATE events SET end = ?, peak_area = ?, mean_area = ? WHERE path = ?',
+                (end, peak_area, mean_area, path))
+
+  def uploaded(self, path, success):
+    """Record the outcome of an upload attempt of a recording."""
+    self.submit("UPDATE events SET upload = ?, attempts = attempts + 1 WHERE path = ?",
+                ('uploaded' if success else 'failed', path))
+
+  def add_second(self, second, frames, moving, largest, motion_frames):
+    self.submit('INSERT OR REPLACE INTO motion VALUES (?, ?, ?, ?, ?)',
+                (second, frames, moving, largest, motion_frames))
+
+  def query(self, sql, params=()):
+    """Run a query on a connection of its own, which WAL lets run alongside
+    the writer."""
+    db = sqlite3.connect(self.path, timeout=10)
+    try:
+      return db.execute(sql, params).fetchall()
+    finally:
+      db.close()
+
+  def events(self, since, until=None):
+    """Events that started between since and until, oldest first."""
+    return self.query('SELECT path, start, end, trigger_frame, peak_area, mean_area, exposure_speed, '
+                      'analog_gain, digital_gain, upload, attempts FROM events '
+                      'WHERE start >= ? AND start < ? ORDER BY start',
+                      (since, until or float('inf')))
+
+  def series(self, since, until=None):
+    """Per-second motion statistics between since and until, oldest first."""
+    return self.query('SELECT * FROM motion WHERE second >= ? AND second < ? ORDER BY second',
+                      (int(since), int(until) if until else 1 << 62))
+
+
+class MotionSeries(object):
+  """Aggregates the statistics of every analysed frame into one row per
+  second for the event store, and the largest areas of motion since the last
+  mark() for event summaries. Called from the motion analysis, so it only adds
+  up numbers and queues a row once a second."""
+
+  def __init__(self, store):
+    self.store = store
+    self._lock = threading.Lock()
+    self._second = None
+    self._frames = self._moving = self._largest = self._motion = 0
+    self.mark()
+
+  def add(self, moving, largest, motion):
+    """Account an analysed frame: the number of MV blocks above the noise
+    field, the largest area of motion and whether it counts as motion."""
+    second = int(time.time())
+    if second != self._second:
+      self.flush()
+      self._second = second
+    # numpy integers would be stored as blobs
+    moving, largest = int(moving), int(largest)
+    self._frames += 1
+    self._moving += moving
+    self._largest = max(self._largest, largest)
+    if motion:
+      self._motion += 1
+    with self._lock:
+      self._peak = max(self._peak, largest)
+      if motion:
+        self._event_area += largest
+        self._event_frames += 1
+
+  def flush(self):
+    """Queue the row of the second so far, e.g. once the analysis has stopped,
+    as it is otherwise only queued when the next second starts."""
+    if self._frames:
+      self.store.add_second(self._second, self._frames, self._moving / self._frames,
+                            self._largest, self._motion)
+    self._frames = self._moving = self._largest = self._motion = 0
+
+  def mark(self):
+    """Start summarizing from here."""
+    with self._lock:
+      self._peak = self._event_area = self._event_frames = 0
+
+  def summary(self):
+    """Peak and mean largest area of motion of the frames with motion since
+    mark()."""
+    with self._lock:
+      return int(self._peak), self._event_area / self._event_frames if self._event_frames else 0.0
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--db', default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                   os.getenv('PYCAM_EVENT_DB', 'events.db')))
+  parser.add_argument('--days', type=float, default=7, help="how far to look back")
+  parser.add_argument('--series', action='store_true', help="also list the minutes with motion, summed up from the per-second statistics")
+  args = parser.parse_args()
+  since = time.time() - args.days * 86400
+  db = sqlite3.connect(args.db)
+  for path, start, end, trigger_frame, peak, mean, upload in db.execute(
+      'SELECT path, start, end, trigger_frame, peak_area, mean_area, upload FROM events '
+      'WHERE start >= ? ORDER BY start', (since,)):
+    print("{0}  {1:>6}  peak {2:>4} mean {3:>6.1f}  {4:<8}  {5}".format(
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)),
+        '{0:.0f}s'.format(end - start) if end else '-', peak or 0, mean or 0.0, upload,
+        os.path.basename(path)))
+  if args.series:
+    for minute, frames, moving, largest, motion_frames in db.execute(
+        'SELECT second / 60, sum(frames), sum(moving * frames) / sum(frames), max(largest), '
+        'sum(motion_frames) FROM motion WHERE second >= ? GROUP BY second / 60 '
+        'HAVING sum(motion_frames) > 0', (int(since),)):
+      print("{0}  moving {1:>6.1f}  largest {2:>4}  motion {3:>4}/{4} frames".format(
+          time.strftime('%Y-%m-%d %H:%M', time.localtime(minute * 60)), moving, largest,
+          motion_frames, frames))
+
+
+if __name__ == '__main__':
+  main()
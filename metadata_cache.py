@@ -0,0 +1,65 @@
+import os
+import json
+import time
+import logging
+import threading
+
+
+class MetadataCache(object):
+  """Small key-value cache for remote metadata, such as the IDs of upload folders,
+  that would otherwise cost an API round-trip per upload. Entries expire after
+  ttl seconds, and the cache is persisted to a JSON file so that it is still
+  warm after a restart.
+  """
+
+  def __init__(self, path, ttl=86400):
+    """Initialize metadata cache
+
+    Parameters
+    ----------
+    path : JSON file to persist the cache to, created on first write
+    ttl : seconds after which an entry expires
+    """
+    self.path = path
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._entries = {}
+    try:
+      with open(path, 'r') as f:
+        self._entries = json.load(f)
+    except FileNotFoundError:
+      pass
+    except (OSError, ValueError) as e:
+      logging.warning("ignoring unreadable metadata cache '{0}': {1}".format(path, e))
+
+  def get(self, key):
+    """Cached value for key, or None if missing or expired."""
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return None
+      value, expires = entry
+      if expires < time.time():
+        del self._entries[key]
+        return None
+      return value
+
+  def put(self, key, value):
+    with self._lock:
+      self._entries[key] = (value, time.time() + self.ttl)
+      self._save()
+
+  def invalidate(self, key):
+    """Drop key, e.g. after a write that relied on it has failed."""
+    with self._lock:
+      if self._entries.pop(key, None) is not None:
+        self._save()
+
+  def _save(self):
+    tmp = self.path + '.tmp'
+    try:
+      with open(tmp, 'w') as f:
+        json.dump(self._entries, f)
+      os.replace(tmp, self.path)
+    except OSError as e:
+      logging.warning("while saving metadata cache: %s" % e)
@@ -0,0 +1,186 @@
+import sys
+import time
+import logging
+import threading
+import traceback
+import collections
+import http.server
+import urllib.parse
+
+# Runtime metrics of the detection and recording pipeline, exposed in the
+# Prometheus text format by MetricsServer along with an on-demand sampling
+# profiler. Metrics are created once at module level by the code they measure:
+#
+#   analyse_seconds = metrics.histogram('pycam_analyse_seconds', 'Time to analyse a frame')
+#   analyse_seconds.observe(elapsed)
+
+latency_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+duration_buckets = (.1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_registry = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+class Counter(object):
+  kind = 'counter'
+
+  def __init__(self, name, help):
+    self.name = name
+    self.help = help
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def inc(self, amount=1):
+    with self._lock:
+      self.value += amount
+
+  def samples(self):
+    return [(self.name, self.value)]
+
+
+class Gauge(object):
+  """Gauge which is either set, or read from func when collected."""
+  kind = 'gauge'
+
+  def __init__(self, name, help, func=None):
+    self.name = name
+    self.help = help
+    self.value = 0
+    self.func = func
+
+  def set(self, value):
+    self.value = value
+
+  def samples(self):
+    return [(self.name, self.func() if self.func else self.value)]
+
+
+class Histogram(object):
+  kind = 'histogram'
+
+  def __init__(self, name, help, buckets=latency_buckets):
+    self.name = name
+    self.help = help
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self._lock = threading.Lock()
+
+  def observe(self, value):
+    i = 0
+    while i < len(self.buckets) and value > self.buckets[i]:
+      i += 1
+    with self._lock:
+      self.counts[i] += 1
+      self.sum += value
+
+  def samples(self):
+    with self._lock:
+      counts, total = list(self.counts), self.sum
+    samples = []
+    cumulative = 0
+    for bound, count in zip(self.buckets + ('+Inf',), counts):
+      cumulative += count
+      samples.append(('%s_bucket{le="%s"}' % (self.name, bound), cumulative))
+    samples.append((self.name + '_sum', total))
+    samples.append((self.name + '_count', cumulative))
+    return samples
+
+
+def _get(cls, name, *args):
+  with _lock:
+    if name not in _registry:
+      _registry[name] = cls(name, *args)
+    return _registry[name]
+
+
+def counter(name, help):
+  return _get(Counter, name, help)
+
+
+def gauge(name, help, func=None):
+  """Gauge of the given name. A func given here replaces any previous one."""
+  metric = _get(Gauge, name, help)
+  if func is not None:
+    metric.func = func
+  return metric
+
+
+def histogram(name, help, buckets=latency_buckets):
+  return _get(Histogram, name, help, buckets)
+
+
+def exposition():
+  """All metrics in the Prometheus text exposition format."""
+  lines = []
+  for metric in list(_registry.values()):
+    lines.append('# HELP %s %s' % (metric.name, metric.help))
+    lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+    try:
+      for name, value in metric.samples():
+        lines.append('%s %s' % (name, value))
+    except Exception as e:
+      logging.debug("while collecting %s: %s" % (metric.name, e))
+  return '\n'.join(lines) + '\n'
+
+
+def sample_stacks(seconds=10.0, interval=0.01):
+  """Sampling profiler: every interval, record the stack of every other thread.
+  Returns the sampled stacks in collapsed format ('thread;frame;frame count',
+  most frequent first), ready for flamegraph tools. It only costs while running."""
+  names = {}
+  stacks = collections.Counter()
+  me = threading.get_ident()
+  end = time.monotonic() + seconds
+  while time.monotonic() < end:
+    for thread in threading.enumerate():
+      names[thread.ident] = thread.name
+    for ident, frame in sys._current_frames().items():
+      if ident == me:
+        continue
+      stack = ['%s:%s' % (f.name, f.lineno) for f in traceback.extract_stack(frame)]
+      stacks[';'.join([names.get(ident, str(ident))] + stack)] += 1
+    time.sleep(interval)
+  return ''.join('%s %d\n' % (stack, count) for stack, count in stacks.most_common())
+
+
+class MetricsServer(threading.Thread):
+  """Background HTTP server for local monitoring. GET /metrics returns all
+  metrics, GET /profile?seconds=10&interval=0.01 profiles all threads for a
+  while and returns their collapsed stacks."""
+
+  def __init__(self, port, host='127.0.0.1'):
+    super().__init__(name="metrics", daemon=True)
+    self.server = http.server.ThreadingHTTPServer((host, port), _Handler)
+
+  def run(self):
+    logging.info("serving metrics on http://{0}:{1}/metrics".format(*self.server.server_address))
+    self.server.serve_forever()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    url = urllib.parse.urlparse(self.path)
+    query = urllib.parse.parse_qs(url.query)
+    if url.path == '/metrics':
+      body = exposition()
+    elif url.path == '/profile':
+      try:
+        body = sample_stacks(float(query.get('seconds', [10])[0]),
+                             float(query.get('interval', [0.01])[0]))
+      except ValueError as e:
+        self.send_error(400, str(e))
+        return
+    else:
+      self.send_error(404)
+      return
+    body = body.encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    logging.debug("metrics: " + format % args)
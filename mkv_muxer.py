@@ -0,0 +1,273 @@
+import os
+import struct
+
+# Matroska element IDs used by the muxer
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+INFO = 0x1549A966
+TRACKS = 0x1654AE6B
+CLUSTER = 0x1F43B675
+CUES = 0x1C53BB6B
+UNKNOWN_SIZE = b'\x01\xff\xff\xff\xff\xff\xff\xff'
+
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SPS = 7
+NAL_PPS = 8
+
+
+def vint(value):
+  """EBML variable size integer, used for element sizes."""
+  length = 1
+  while value >= (1 << (7 * length)) - 1:
+    length += 1
+  return ((1 << (7 * length)) | value).to_bytes(length, 'big')
+
+
+def element(id, payload):
+  if isinstance(payload, int):
+    payload = payload.to_bytes(max((payload.bit_length() + 7) // 8, 1), 'big')
+  elif isinstance(payload, float):
+    payload = struct.pack('>d', payload)
+  elif isinstance(payload, str):
+    payload = payload.encode('utf-8')
+  return id.to_bytes((id.bit_length() + 7) // 8, 'big') + vint(len(payload)) + payload
+
+
+def nal_units(data):
+  """Split an H.264 Annex B byte stream into its NAL units (without start codes)."""
+  data = bytes(data)
+  units = []
+  start = data.find(b'\x00\x00\x01')
+  while start >= 0:
+    start += 3
+    end = data.find(b'\x00\x00\x01', start)
+    unit = data[start:end if end >= 0 else len(data)].rstrip(b'\x00')
+    if unit:
+      units.append(unit)
+    start = end
+  return units
+
+
+def simple_block(units, time, keyframe):
+  """SimpleBlock element of a picture's NAL units, at time ms from its cluster."""
+  block = struct.pack('>BhB', 0x81, time, 0x80 if keyframe else 0)
+  block += b''.join(struct.pack('>I', len(unit)) + unit for unit in units)
+  return element(0xA3, block)
+
+
+def mux_blocks(frames):
+  """Mux H.264 frames, given as (Annex B data, timestamp in us or None) pairs
+  and starting with a keyframe, into the SimpleBlocks of a cluster, to be
+  linked into recordings later with MatroskaWriter.link(). Returns the blocks,
+  the timestamps of the first and last picture, and the SPS and PPS."""
+  blocks = []
+  pending = []
+  sps = pps = first = last = None
+  for data, timestamp in frames:
+    units = nal_units(data)
+    for unit in units:
+      kind = unit[0] & 0x1f
+      if kind == NAL_SPS and sps is None:
+        sps = unit
+      elif kind == NAL_PPS and pps is None:
+        pps = unit
+    if not any(NAL_SLICE <= unit[0] & 0x1f <= NAL_IDR for unit in units):
+      pending.extend(units)
+      continue
+    units = pending + units
+    pending = []
+    if timestamp is None:
+      timestamp = last if last is not None else 0
+    if first is None:
+      first = timestamp
+    last = timestamp = max(timestamp, last or first)
+    keyframe = any(unit[0] & 0x1f == NAL_IDR for unit in units)
+    blocks.append(simple_block(units, (timestamp - first) // 1000, keyframe))
+  return b''.join(blocks), first, last, sps, pps
+
+
+def copy_range(source, offset, size, output):
+  """Copy size bytes at offset of the file descriptor source to the end of a
+  file object, within the kernel where possible (and as a reflink on file
+  systems that support it)."""
+  try:
+    output.flush()
+    target = output.fileno()
+    position = output.tell()
+  except (AttributeError, OSError, ValueError):
+    target = None  # not a file, e.g. BytesIO
+  copied = 0
+  if target is not None:
+    copy = getattr(os, 'copy_file_range', None)
+    try:
+      while copied < size:
+        if copy:
+          count = copy(source, target, size - copied, offset + copied, position + copied)
+        else:
+          os.lseek(target, position + copied, os.SEEK_SET)
+          count = os.sendfile(target, source, offset + copied, size - copied)
+        if not count:
+          break
+        copied += count
+    except OSError:
+      pass  # e.g. across file systems on older kernels, copy the rest here
+    output.seek(position + copied)
+  while copied < size:
+    chunk = os.pread(source, min(size - copied, 1 << 20), offset + copied)
+    if not chunk:
+      raise EOFError("pre-muxed cluster cut short")
+    output.write(chunk)
+    copied += len(chunk)
+  return copied
+
+
+class MatroskaWriter(object):
+  """Streaming Matroska muxer for the camera's H.264 stream. Frames are written
+  as they are recorded, with their own timestamps, so that the variable frame
+  rate is preserved and the file is complete as soon as it is closed. Each call
+  to write() ends a cluster, so nothing is held back in memory in between.
+  """
+
+  def __init__(self, output, width, height, framerate=10):
+    """Initialize Matroska writer
+
+    Parameters
+    ----------
+    output : binary file object, closed with the writer
+    width, height : video resolution
+    framerate : frame rate assumed for frames without timestamp
+    """
+    self.output = output
+    self.width = width
+    self.height = height
+    self.frame_duration = 1000 / framerate  # ms
+    self._sps = self._pps = None
+    self._pending = []  # parameter sets waiting for the next picture
+    self._origin = None  # timestamp of the first frame in us
+    self._last = None  # time of the last frame in ms
+    self._segment = None  # file offset of the segment payload
+    self._duration = None  # file offset of the duration value
+    self._cues = []
+    self._cluster = None
+    self._cluster_time = 0
+
+  def write(self, frames):
+    """Mux H.264 frames, given as (Annex B data, timestamp in us or None) pairs.
+    Returns the number of bytes written to the output."""
+    written = 0
+    for data, timestamp in frames:
+      written += self._frame(data, timestamp)
+    return written + self._flush()
+
+  def _frame(self, data, timestamp):
+    written = 0
+    units = nal_units(data)
+    for unit in units:
+      kind = unit[0] & 0x1f
+      if kind == NAL_SPS and self._sps is None:
+        self._sps = unit
+      elif kind == NAL_PPS and self._pps is None:
+        self._pps = unit
+    if not any(NAL_SLICE <= unit[0] & 0x1f <= NAL_IDR for unit in units):
+      # parameter sets or SEI only, send them along with the next picture
+      self._pending.extend(units)
+      return 0
+    if self._segment is None:
+      if self._sps is None or self._pps is None:
+        return 0  # can't decode anything before the first parameter sets
+      written += self._header()
+    units = self._pending + units
+    self._pending = []
+
+    if timestamp is None:
+      time = self._last + self.frame_duration if self._last is not None else 0
+    else:
+      if self._origin is None:
+        self._origin = timestamp - 1000 * (self._last or 0)
+      time = (timestamp - self._origin) / 1000
+    self._last = time = max(time, self._last or 0)
+    keyframe = any(unit[0] & 0x1f == NAL_IDR for unit in units)
+
+    if keyframe or self._cluster is None or time - self._cluster_time > 30000:
+      written += self._flush()
+      self._cluster = bytearray(element(0xE7, int(time)))
+      self._cluster_time = int(time)
+      if keyframe:
+        self._cues.append((int(time), self.output.tell() - self._segment))
+    self._cluster += simple_block(units, int(time) - self._cluster_time, keyframe)
+    return written
+
+  def link(self, source, offset, size, first, last, sps, pps):
+    """Append a cluster of SimpleBlocks pre-muxed by mux_blocks(), size bytes
+    at offset of the file descriptor source, without muxing them again. first
+    and last are the timestamps of its first and last picture in us. Returns
+    the number of bytes written."""
+    written = self._flush()
+    if self._segment is None:
+      self._sps = self._sps or sps
+      self._pps = self._pps or pps
+      written += self._header()
+    if self._origin is None:
+      self._origin = first - 1000 * (self._last or 0)
+    time = max((first - self._origin) / 1000, self._last or 0)
+    self._cues.append((int(time), self.output.tell() - self._segment))
+    head = element(0xE7, int(time))
+    self.output.write(CLUSTER.to_bytes(4, 'big') + vint(len(head) + size) + head)
+    written += 4 + len(vint(len(head) + size)) + len(head)
+    written += copy_range(source, offset, size, self.output)
+    self._last = max(time + (last - first) / 1000, self._last or 0)
+    return written
+
+  def _flush(self):
+    """Write out the cluster in progress."""
+    if not self._cluster:
+      return 0
+    cluster = element(CLUSTER, bytes(self._cluster))
+    self._cluster = None
+    self.output.write(cluster)
+    return len(cluster)
+
+  def _header(self):
+    sps = self._sps
+    avcc = bytes([1, sps[1], sps[2], sps[3], 0xff, 0xe1]) + struct.pack('>H', len(sps)) + sps + \
+        bytes([1]) + struct.pack('>H', len(self._pps)) + self._pps
+    header = element(EBML,
+                     element(0x4286, 1) + element(0x42F7, 1) + element(0x42F2, 4) +
+                     element(0x42F3, 8) + element(0x4282, 'matroska') +
+                     element(0x4287, 4) + element(0x4285, 2))
+    header += SEGMENT.to_bytes(4, 'big') + UNKNOWN_SIZE
+    self._segment = self.output.tell() + len(header)
+    info = element(0x2AD7B1, 1000000) + element(0x4D80, 'pycam') + element(0x5741, 'pycam')
+    # the duration is filled in on close, if the output is seekable
+    self._duration = self._segment + len(element(INFO, info + element(0x4489, 0.0))) - 8
+    header += element(INFO, info + element(0x4489, 0.0))
+    header += element(TRACKS, element(0xAE,
+                                      element(0xD7, 1) + element(0x73C5, 1) + element(0x83, 1) +
+                                      element(0x9C, 0) + element(0x86, 'V_MPEG4/ISO/AVC') +
+                                      element(0x63A2, avcc) +
+                                      element(0xE0, element(0xB0, self.width) + element(0xBA, self.height))))
+    self.output.write(header)
+    return len(header)
+
+  def close(self):
+    """Finish the file with an index of keyframes, and fill in segment size and
+    duration where the output allows seeking back."""
+    written = self._flush()
+    if self._segment is not None:
+      cues = b''.join(element(0xBB, element(0xB3, time) +
+                              element(0xB7, element(0xF7, 1) + element(0xF1, position)))
+                      for time, position in self._cues)
+      if cues:
+        cues = element(CUES, cues)
+        self.output.write(cues)
+        written += len(cues)
+      if self.output.seekable():
+        end = self.output.tell()
+        self.output.seek(self._segment - 8)
+        self.output.write((end - self._segment | 1 << 56).to_bytes(8, 'big'))
+        self.output.seek(self._duration)
+        self.output.write(struct.pack('>d', (self._last or 0) + self.frame_duration))
+        self.output.seek(end)
+    self.output.close()
+    return written
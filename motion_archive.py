@@ -0,0 +1,191 @@
+import os
+import mmap
+import time
+import zlib
+import glob
+import struct
+import numpy as np
+from motion_vector_reader import motion_dtype
+
+# Motion vector archive: a compact, indexed file format for logging motion
+# vectors continuously. A file starts with a header and an index of fixed size
+# entries, one per frame, followed by the frame records. The index is allocated
+# up front, so the file can be memory-mapped and any frame found by its position,
+# camera frame index or timestamp without reading the others; frames stored raw
+# are even read without a copy. Frames can be stored with the SAD quantized to
+# 8 bits and/or compressed. ArchiveWriter starts a new file once one has grown
+# to max_bytes, and keeps at most max_files of them.
+
+MAGIC = b'PYCAMMVA'
+VERSION = 1
+extension = '.mva'
+
+# magic, version, rows, cols, SAD shift (255 if not quantized), index capacity
+header = struct.Struct('<8sHHHBxI')
+HEADER_SIZE = 32
+index_dtype = np.dtype([('offset', '<u8'), ('timestamp', '<i8'), ('index', '<u4'),
+                        ('size', '<u4'), ('flags', '<u4'), ('reserved', '<u4')])
+quantized_dtype = np.dtype([('x', 'i1'), ('y', 'i1'), ('sad', 'u1')])
+
+MOTION = 1  # the reader detected motion in the frame
+COMPRESSED = 2  # the record is zlib compressed
+NO_SHIFT = 255
+NO_TIMESTAMP = -1
+
+
+class ArchiveWriter(object):
+  """Writes motion vector frames into a rotating set of archive files."""
+
+  def __init__(self, directory, max_bytes=64 << 20, max_files=0, sad_shift=None,
+               compress=False, prefix='motion'):
+    """Initialize archive writer
+
+    Parameters
+    ----------
+    directory : where archive files are created
+    max_bytes : size at which a new file is started
+    max_files : number of files to keep, deleting the oldest, or 0 to keep all
+    sad_shift : store the SAD in 8 bits, shifted right by this many bits, or None
+                to store it exactly
+    compress : zlib compress every frame, worthwhile for mostly still scenes
+    """
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.max_files = max_files
+    self.sad_shift = sad_shift
+    self.compress = compress
+    self.prefix = prefix
+    self.path = None
+    self._fd = None
+    os.makedirs(directory, exist_ok=True)
+
+  def _open(self, shape):
+    self.close()
+    rows, cols = shape
+    # a conservative guess at the number of frames that fit, at a byte per block
+    capacity = max(self.max_bytes // (rows * cols), 16)
+    name = '{0}-{1}{2}'.format(self.prefix, time.strftime('%Y%m%d-%H%M%S'), extension)
+    self.path = os.path.join(self.directory, name)
+    if os.path.exists(self.path):
+      self.path = self.path[:-len(extension)] + '-{0:x}{1}'.format(time.monotonic_ns(), extension)
+    self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    shift = NO_SHIFT if self.sad_shift is None else self.sad_shift
+    os.write(self._fd, header.pack(MAGIC, VERSION, rows, cols, shift, capacity).ljust(HEADER_SIZE, b'\0'))
+    self._data = HEADER_SIZE + capacity * index_dtype.itemsize
+    os.ftruncate(self._fd, self._data)
+    self._shape = shape
+    self._capacity = capacity
+    self._count = 0
+    self._entry = np.zeros(1, dtype=index_dtype)
+    self._rotate()
+
+  def _rotate(self):
+    if self.max_files:
+      files = sorted(glob.glob(os.path.join(self.directory, self.prefix + '-*' + extension)),
+                     key=os.path.getmtime)
+      for old in files[:-self.max_files]:
+        if old != self.path:
+          os.remove(old)
+
+  def write(self, a, index=0, timestamp=None, motion=False):
+    """Append a frame of motion vectors."""
+    if self._fd is None or a.shape != self._shape or self._count >= self._capacity or \
+        self._data >= self.max_bytes:
+      self._open(a.shape)
+    if self.sad_shift is not None:
+      q = np.empty(a.shape, dtype=quantized_dtype)
+      q['x'] = a['x']
+      q['y'] = a['y']
+      q['sad'] = np.minimum(a['sad'] >> self.sad_shift, 255)
+      a = q
+    data = a.tobytes()
+    flags = MOTION if motion else 0
+    if self.compress:
+      data = zlib.compress(data, 1)
+      flags |= COMPRESSED
+    os.pwrite(self._fd, data, self._data)
+    # the index entry goes last, so that a frame is complete once it is indexed
+    entry = self._entry
+    entry['offset'] = self._data
+    entry['timestamp'] = NO_TIMESTAMP if timestamp is None else timestamp
+    entry['index'] = index
+    entry['size'] = len(data)
+    entry['flags'] = flags
+    os.pwrite(self._fd, entry.tobytes(), HEADER_SIZE + self._count * index_dtype.itemsize)
+    self._data += len(data)
+    self._count += 1
+
+  def close(self):
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+
+
+class Archive(object):
+  """Memory-mapped reader of an archive file. Frames are found by position
+  (archive[i]), camera frame index (find_index) or timestamp (find_timestamp)."""
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, rows, cols, shift, capacity = header.unpack_from(self._mmap)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("{0}: not a motion vector archive".format(path))
+    self.path = path
+    self.shape = (rows, cols)
+    self.sad_shift = None if shift == NO_SHIFT else shift
+    index = np.frombuffer(self._mmap, dtype=index_dtype, count=capacity, offset=HEADER_SIZE)
+    # frames are indexed in order, after their data: the first empty entry, or one
+    # pointing past the end of a file cut short, is the end
+    valid = (index['size'] > 0) & (index['offset'] + index['size'] <= len(self._mmap))
+    self.index = index[:np.argmin(valid) if not valid.all() else capacity]
+
+  def __len__(self):
+    return len(self.index)
+
+  def __getitem__(self, i):
+    """Motion vectors of the i-th frame. Read-only, and without a copy if
+    stored raw."""
+    entry = self.index[i]
+    dtype = motion_dtype if self.sad_shift is None else quantized_dtype
+    if entry['flags'] & COMPRESSED:
+      data = zlib.decompress(self._mmap[entry['offset']:entry['offset'] + entry['size']])
+      a = np.frombuffer(data, dtype=dtype).reshape(self.shape)
+    else:
+      a = np.frombuffer(self._mmap, dtype=dtype, count=self.shape[0] * self.shape[1],
+                        offset=int(entry['offset'])).reshape(self.shape)
+    if self.sad_shift is not None:
+      q = a
+      a = np.empty(self.shape, dtype=motion_dtype)
+      a['x'] = q['x']
+      a['y'] = q['y']
+      a['sad'] = (q['sad'].astype(np.uint16) << self.sad_shift) | (1 << self.sad_shift >> 1)
+    return a
+
+  def __iter__(self):
+    """Yields (frame index, motion, array) like motion_replay.read_motion_vectors."""
+    for i in range(len(self)):
+      yield int(self.index['index'][i]), bool(self.index['flags'][i] & MOTION), self[i]
+
+  def find_index(self, index):
+    """Position of the first frame with a camera frame index of at least index."""
+    return int(np.searchsorted(self.index['index'], index))
+
+  def find_timestamp(self, timestamp):
+    """Position of the first frame with a timestamp (in us) of at least timestamp."""
+    return int(np.searchsorted(self.index['timestamp'], timestamp))
+
+  def close(self):
+    """Unmap the file, unless frames read without a copy are still in use."""
+    self.index = None
+    try:
+      self._mmap.close()
+    except BufferError:
+      pass  # unmapped once the last frame is gone
+
+
+def archive_files(path):
+  """Archive files in a directory, oldest first, or the file itself."""
+  if os.path.isdir(path):
+    return sorted(glob.glob(os.path.join(path, '*' + extension)), key=os.path.getmtime)
+  return [path]
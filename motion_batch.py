@@ -0,0 +1,127 @@
+import numpy as np
+from scipy import ndimage
+
+# Batch version of MotionVectorReader.analyse() for offline analysis, e.g. to
+# tune detection settings. It gives the same results as analysing the frames
+# one by one without load shedding, but processes whole stacks of frames (a 3D
+# array of MV frames) at once: magnitudes, thresholds and the labelling of
+# connected areas of motion are each computed in one pass over the stack.
+#
+# The largest area of motion per frame only depends on the window, and only
+# through the noise decay, so it can be computed once and then be reused for
+# any area and frames setting by trigger_timeline().
+
+# connect MV blocks within a frame, never across frames
+_structure = np.zeros((3, 3, 3), dtype=bool)
+_structure[1] = ndimage.generate_binary_structure(2, 1)
+
+
+def noise_shift(window):
+  """Decay rate of the noise field, in bits, for a window of frames."""
+  return max(window.bit_length() - 2, 0)
+
+
+def analyse_stack(stack, window, noise=None, weights=None):
+  """Largest area of motion (in MV blocks) in every frame of a stack of MV
+  frames. noise is the noise field left by the previous frame, if any, and is
+  updated in place. Without, it starts at the SAD of the first frame, as in
+  MotionVectorReader. weights are the block weights of motion_mask, if any.
+  Returns the largest areas and the noise field."""
+  shift = noise_shift(window)
+  if noise is None:
+    noise = stack[0]['sad'].astype(np.int32)
+  # the noise field is a recurrence, so it takes a loop over frames
+  thresholds = np.right_shift(stack['sad'], shift, dtype=np.int32)
+  scratch = np.empty_like(noise)
+  for threshold in thresholds:
+    np.right_shift(noise, shift, out=scratch)
+    noise -= scratch
+    noise -= 1
+    noise += threshold
+    np.maximum(noise, 0, out=noise)
+    threshold[...] = noise
+  # every MV at least as long as the current noise allows, in squared lengths
+  thresholds >>= 4
+  thresholds += 1
+  weighted = weights is not None and not np.isin(weights, (0, 255)).all()
+  if weighted:
+    np.minimum(thresholds, 182, out=thresholds)  # as MotionVectorReader.detect()
+  np.multiply(thresholds, thresholds, out=thresholds)
+  # squares of int8 fit int16, and their sum uint16
+  magnitude = stack['x'].astype(np.int16)
+  magnitude *= magnitude
+  magnitude = magnitude.view(np.uint16)
+  y = stack['y'].astype(np.int16)
+  y *= y
+  magnitude += y.view(np.uint16)
+  if weighted:
+    thresholds *= 255
+    mask = magnitude * weights.astype(np.int32) >= thresholds
+  else:
+    mask = magnitude >= thresholds
+  if weights is not None and not weighted:
+    mask &= weights > 0
+
+  # labels are numbered in scan order, so the labels of a frame follow on those
+  # of the frames before it
+  labels, count = ndimage.label(mask, structure=_structure)
+  sizes = np.bincount(labels.ravel(), minlength=count + 1)
+  ends = np.maximum.accumulate(labels.reshape(len(stack), -1).max(axis=1))
+  starts = np.concatenate(([1], ends[:-1] + 1))
+  largest = np.zeros(len(stack), dtype=np.int64)
+  found = ends >= starts
+  if found.any():
+    largest[found] = np.maximum.reduceat(sizes, starts[found])
+  return largest, noise
+
+
+def largest_areas(frames, window, chunk=1000, weights=None):
+  """Largest area of motion of every frame in an iterable of MV frames, taking
+  them in stacks of chunk frames to bound memory use. Areas are 0 while the
+  noise field settles, as motion doesn't count then in MotionVectorReader."""
+  noise = None
+  results = []
+  stack = []
+  for a in frames:
+    stack.append(a)
+    if len(stack) == chunk:
+      largest, noise = analyse_stack(np.stack(stack), window, noise, weights)
+      results.append(largest)
+      stack = []
+  if stack:
+    largest, noise = analyse_stack(np.stack(stack), window, noise, weights)
+    results.append(largest)
+  largest = np.concatenate(results) if results else np.zeros(0, dtype=np.int64)
+  largest[:1 << noise_shift(window)] = 0
+  return largest
+
+
+def _since(events):
+  """Number of frames since events was last true, counting from 1 << 30
+  before the first event, like MotionVectorReader's counters."""
+  index = np.arange(len(events))
+  last = np.maximum.accumulate(np.where(events, index, -1))
+  return np.where(last >= 0, index - last, (1 << 30) + index + 1)
+
+
+def trigger_timeline(largest, area, frames, window):
+  """Motion and trigger state of every frame for a detection setting, given
+  the largest areas of motion from analyse_stack(). Mirrors the run tracking of
+  MotionVectorReader, vectorized over frames. Returns the motion and the
+  trigger state of every frame as boolean arrays."""
+  motion = largest >= area
+  index = np.arange(len(motion))
+  run = index - np.maximum.accumulate(np.where(motion, -1, index))
+  since_repeated = _since(run >= frames)
+  since_motion = _since(motion)
+  # set, clear or else keep the trigger as it was
+  events = np.where(since_repeated <= window - frames, 1, np.where(since_motion >= window, 0, -1))
+  last = np.maximum.accumulate(np.where(events >= 0, index, -1))
+  trigger = np.where(last >= 0, events[last] == 1, False)
+  return motion, trigger
+
+
+def trigger_intervals(trigger):
+  """(first, last) frame positions of every interval the trigger was set."""
+  edges = np.diff(np.concatenate(([0], trigger.astype(np.int8), [0])))
+  return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1))
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+"""Watch the live motion field that a MotionVectorReader publishes in shared
+memory (PYCAM_FIELD_SHM), from another process.
+
+  python3 motion_field.py pycam-field
+"""
+
+import time
+import argparse
+import collections
+import numpy as np
+from multiprocessing import shared_memory
+
+# Live motion field in shared memory: a ring of slots, each holding the squared
+# MV lengths (before region of interest weights), the motion mask and the noise
+# field of an analysed frame, and its statistics. The analysis writes every
+# frame into the next slot and readers in other processes take the latest one,
+# without locks: each slot has a sequence number which is odd while the slot is
+# being written, and which readers compare before and after reading to detect a
+# torn read (a seqlock). A reader has slots - 1 frame times to use a slot
+# without copying it.
+
+MAGIC = b'PYCAMMVF'
+VERSION = 1
+
+header_dtype = np.dtype([('magic', 'S8'), ('version', '<u2'), ('slots', '<u2'), ('rows', '<u2'),
+                         ('cols', '<u2'), ('published', '<u8')])
+slot_dtype = np.dtype([('seq', '<u8'), ('index', '<i8'), ('timestamp', '<i8'), ('rows', '<u2'),
+                       ('cols', '<u2'), ('largest', '<u4'), ('moving', '<u4'), ('motion', 'u1'),
+                       ('trigger', 'u1'), ('level', 'u1')])
+ALIGN = 64
+
+Field = collections.namedtuple('Field', ['seq', 'index', 'timestamp', 'largest', 'moving', 'motion',
+                                         'trigger', 'level', 'magnitude', 'mask', 'noise'])
+
+
+def _align(size):
+  return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _layout(rows, cols):
+  """Offsets of the arrays within a slot, and the slot size."""
+  blocks = rows * cols
+  magnitude = _align(slot_dtype.itemsize)
+  noise = magnitude + _align(4 * blocks)
+  mask = noise + _align(4 * blocks)
+  return magnitude, noise, mask, _align(mask + blocks)
+
+
+class _Ring(object):
+
+  def _map(self, buf, slots, rows, cols):
+    self._header = np.ndarray((), dtype=header_dtype, buffer=buf)
+    magnitude, noise, mask, size = _layout(rows, cols)
+    self._slots = []
+    for slot in range(slots):
+      offset = _align(header_dtype.itemsize) + slot * size
+      self._slots.append((
+          np.ndarray((), dtype=slot_dtype, buffer=buf, offset=offset),
+          np.ndarray(rows * cols, dtype=np.int32, buffer=buf, offset=offset + magnitude),
+          np.ndarray(rows * cols, dtype=bool, buffer=buf, offset=offset + mask),
+          np.ndarray(rows * cols, dtype=np.int32, buffer=buf, offset=offset + noise)))
+
+
+class FieldPublisher(_Ring):
+  """Publishes the motion field of every analysed frame, see MotionVectorReader.publish_field()."""
+
+  def __init__(self, name, shape, slots=4):
+    """Initialize field publisher
+
+    Parameters
+    ----------
+    name : name of the shared memory block, replacing one left over by a crash
+    shape : largest MV array shape to be published
+    slots : number of frames in the ring
+    """
+    rows, cols = shape
+    size = _align(header_dtype.itemsize) + slots * _layout(rows, cols)[3]
+    try:
+      stale = shared_memory.SharedMemory(name)
+      stale.close()
+      stale.unlink()
+    except FileNotFoundError:
+      pass
+    self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+    self._map(self._shm.buf, slots, rows, cols)
+    self._header[()] = (MAGIC, VERSION, slots, rows, cols, 0)
+    self._capacity = rows * cols
+
+  def publish(self, index, timestamp, magnitude, mask, noise, largest=0, moving=0, motion=False,
+              trigger=False, level=0):
+    published = int(self._header['published'])
+    header, magnitudes, masks, noises = self._slots[published % len(self._slots)]
+    blocks = magnitude.size
+    if blocks > self._capacity:
+      return
+    header['seq'] = 2 * published + 1  # odd: being written
+    header['index'] = index
+    header['timestamp'] = -1 if timestamp is None else timestamp
+    header['rows'], header['cols'] = magnitude.shape
+    header['largest'] = largest
+    header['moving'] = moving
+    header['motion'] = motion
+    header['trigger'] = trigger
+    header['level'] = level
+    np.copyto(magnitudes[:blocks], magnitude.ravel())
+    np.copyto(masks[:blocks], mask.ravel())
+    np.copyto(noises[:blocks], noise.ravel())
+    header['seq'] = 2 * published + 2
+    self._header['published'] = published + 1
+
+  def close(self):
+    self._slots = self._header = None
+    self._shm.close()
+    self._shm.unlink()
+
+
+class FieldReader(_Ring):
+  """Reads the live motion field from another process."""
+
+  def __init__(self, name):
+    self._shm = shared_memory.SharedMemory(name)
+    try:
+      # before Python 3.13, the resource tracker of this process would remove
+      # the block when the process ends, although it belongs to the publisher
+      from multiprocessing import resource_tracker
+      resource_tracker.unregister(self._shm._name, 'shared_memory')
+    except Exception:
+      pass
+    header = np.ndarray((), dtype=header_dtype, buffer=self._shm.buf)
+    if header['magic'] != MAGIC or header['version'] != VERSION:
+      raise ValueError("{0}: not a motion field".format(name))
+    self.shape = (int(header['rows']), int(header['cols']))
+    self._map(self._shm.buf, int(header['slots']), *self.shape)
+
+  def published(self):
+    """Number of frames published so far."""
+    return int(self._header['published'])
+
+  def read(self, copy=True, retries=3):
+    """The latest frame as a Field, or None if there is none yet or it was
+    overwritten while being read (retries times). Without copy, the arrays are
+    views into shared memory: check valid() once done with them."""
+    for _ in range(retries):
+      published = int(self._header['published'])
+      if not published:
+        return None
+      header, magnitude, mask, noise = self._slots[(published - 1) % len(self._slots)]
+      seq = int(header['seq'])
+      if seq != 2 * published:
+        continue  # a newer frame is being written into the slot
+      rows, cols = int(header['rows']), int(header['cols'])
+      arrays = [a[:rows * cols].reshape(rows, cols) for a in (magnitude, mask, noise)]
+      if copy:
+        arrays = [np.array(a) for a in arrays]
+      field = Field(seq, int(header['index']), int(header['timestamp']), int(header['largest']),
+                    int(header['moving']), bool(header['motion']), bool(header['trigger']),
+                    int(header['level']), *arrays)
+      if not copy or self.valid(field):
+        return field
+    return None
+
+  def valid(self, field):
+    """Whether field has not been overwritten since it was read."""
+    published = field.seq // 2
+    return int(self._slots[(published - 1) % len(self._slots)][0]['seq']) == field.seq
+
+  def close(self):
+    """Unmap the shared memory, unless fields read without a copy are still
+    in use."""
+    self._slots = self._header = None
+    try:
+      self._shm.close()
+    except BufferError:
+      pass
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('name', help="shared memory name, PYCAM_FIELD_SHM of the camera")
+  parser.add_argument('--interval', type=float, default=1.0, help="seconds between reads")
+  args = parser.parse_args()
+  reader = FieldReader(args.name)
+  published = reader.published()
+  try:
+    while True:
+      time.sleep(args.interval)
+      field = reader.read()
+      if field is None:
+        continue
+      print("frame {0:>7}  {1:>5.1f} fps  moving {2:>5}  largest {3:>5}  noise {4:>6.0f}{5}{6}".format(
+          field.index, (reader.published() - published) / args.interval, field.moving,
+          field.largest, field.noise.mean(), "  motion" if field.motion else "",
+          "  TRIGGER" if field.trigger else ""))
+      published = reader.published()
+  except KeyboardInterrupt:
+    pass
+  reader.close()
+
+
+if __name__ == '__main__':
+  main()
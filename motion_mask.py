@@ -0,0 +1,83 @@
+import os
+import numpy as np
+from motion_vector_reader import grid_shape
+
+# Region of interest masks for the motion detector: a weight per MV block, from
+# 0 (excluded) to 255 (full sensitivity). In between, a block needs a
+# proportionally larger motion, in squared MV length, to count as moving, e.g.
+# at 64 an MV twice as long as elsewhere. Masks are drawn as grayscale images of
+# any size (white for full sensitivity, black to exclude trees, roads or the
+# camera's own date and time annotation) or saved as numpy arrays, and scaled
+# to the MV grid once, when the camera starts.
+
+FULL = 255
+
+
+def resample(a, shape):
+  """Scale a 2D array to a grid of the given shape, axis by axis: averaged
+  over the cells of a coarser grid, or repeated (nearest neighbour) into a
+  finer one, e.g. for a mask drawn smaller than the MV grid."""
+  a = np.asarray(a, dtype=np.float64)
+  for axis, n in enumerate(shape):
+    size = a.shape[axis]
+    if n <= size:
+      edges = np.arange(n) * size // n
+      counts = np.diff(np.append(edges, size))
+      a = np.add.reduceat(a, edges, axis=axis) / np.expand_dims(counts, 1 - axis)
+    else:
+      a = np.take(a, np.arange(n) * size // n, axis=axis)
+  return a
+
+
+def load_mask(path, resolution):
+  """Load a mask for a camera resolution from an image (e.g. PNG) or a .npy
+  file. Boolean arrays and floats up to 1.0 are taken as 0 to 1 weights,
+  other arrays and images as 0 to 255. Returns the weight of every MV block,
+  with the camera's extra column of blocks excluded."""
+  if os.path.splitext(path)[1].lower() == '.npy':
+    a = np.load(path)
+    if a.dtype == bool or (a.dtype.kind == 'f' and a.max() <= 1.0):
+      a = a * float(FULL)
+  else:
+    from PIL import Image  # only needed for image masks
+    with Image.open(path) as image:
+      a = np.asarray(image.convert('L'))
+  if a.ndim != 2:
+    raise ValueError("{0}: a mask must be 2D, not of shape {1}".format(path, a.shape))
+  rows, cols = grid_shape(*resolution)
+  weights = np.zeros((rows, cols), dtype=np.uint8)
+  weights[:, :-1] = np.clip(np.rint(resample(a, (rows, cols - 1))), 0, FULL)
+  return weights
+
+
+def exclude(weights, box):
+  """Exclude every MV block that overlaps a (left, top, right, bottom) box of
+  pixels, in place."""
+  rows, cols = weights.shape
+  left, top, right, bottom = box
+  weights[max(top, 0) // 16:min((bottom + 15) // 16, rows),
+          max(left, 0) // 16:min((right + 15) // 16, cols - 1)] = 0
+  return weights
+
+
+def annotation_box(resolution, text_size=32, chars=48):
+  """Estimated pixel box of the camera's text annotation: centered at the top,
+  text_size high and about half as wide per character, with some margin."""
+  width, height = resolution
+  text_width = min(chars * text_size // 2, width)
+  return ((width - text_width) // 2, 0, (width + text_width) // 2, text_size * 3 // 2)
+
+
+def region_weights(resolution, path=None, annotation=False):
+  """Block weights for a camera: from a mask file, with the annotation region
+  excluded if annotation is set. None if every block counts fully."""
+  if not path and not annotation:
+    return None
+  if path:
+    weights = load_mask(path, resolution)
+  else:
+    weights = np.full(grid_shape(*resolution), FULL, dtype=np.uint8)
+    weights[:, -1] = 0
+  if annotation:
+    exclude(weights, annotation_box(resolution))
+  return weights
@@ -3,17 +3,32 @@
 import io
 import os
 import threading
-import picamerax as picamera
-import queue
 import signal
 import logging
 import time
 import numpy as np
-from PIL import Image
 from motion_vector_reader import MotionVectorReader
+from recording_writer import RecordingWriter
+from mkv_muxer import MatroskaWriter
+from upload_spool import Spool
+from still_capture import StillCapture
+from event_store import EventStore, MotionSeries
+import preroll
+import motion_mask
+import metrics
 
 current_dir = os.path.dirname(os.path.realpath(__file__))
 
+# camera backend: the Pi camera, or 'simulated' to play back recordings without one
+if os.getenv('PYCAM_CAMERA', 'picamera') == 'simulated':
+  import simulated_camera as picamera
+else:
+  import picamerax as picamera
+
+lock_seconds = metrics.histogram('pycam_buffer_lock_seconds', 'Time the circular buffer is locked by append_buffer')
+snapshot_total = metrics.counter('pycam_buffer_snapshot_bytes_total', 'Bytes copied out of the circular buffer')
+recordings_total = metrics.counter('pycam_recordings_total', 'Recordings of detected motion')
+
 
 class MotionRecorder(threading.Thread):
   """Record video into a circular memory buffer and extract motion vectors for
@@ -23,36 +38,88 @@ class MotionRecorder(threading.Thread):
 
   # half of hardware resolution leaves us HD 4:3 and provides 2x2 binning
   # for V1 camera: 1296x972, for V2 camera: 1640x1232. Also use sensor_mode: 4
-  width = int(os.getenv('PYCAM_WIDTH'))
-  height = int(os.getenv('PYCAM_HEIGHT'))
-  framerate_min = int(os.getenv('PYCAM_FPS_MIN'))  # lowest framerate used e.g. at night
-  framerate_max = int(os.getenv('PYCAM_FPS_MAX'))  # highest frame rate used. lower the max framerate for more time on per-frame analysis
-  bitrate = int(os.getenv('PYCAM_BITRATE_KBPS')) * 1000  # 2Mbps is a high quality stream for 10 fps HD video
-  prebuffer = int(os.getenv('PYCAM_PREBUFFER_SEC'))  # number of seconds to keep in buffer
-  postbuffer = int(os.getenv('PYCAM_POSTBUFFER_SEC'))  # number of seconds to record post end of motion
-  overlay = int(os.getenv('PYCAM_OVERLAY'))
-  capture_still = int(os.getenv('PYCAM_JPEG'))
+  width = int(os.getenv('PYCAM_WIDTH', 1640))
+  height = int(os.getenv('PYCAM_HEIGHT', 1232))
+  framerate_min = int(os.getenv('PYCAM_FPS_MIN', 5))  # lowest framerate used e.g. at night
+  framerate_max = int(os.getenv('PYCAM_FPS_MAX', 15))  # highest frame rate used. lower the max framerate for more time on per-frame analysis
+  bitrate = int(os.getenv('PYCAM_BITRATE_KBPS', 2000)) * 1000  # 2Mbps is a high quality stream for 10 fps HD video
+  prebuffer = int(os.getenv('PYCAM_PREBUFFER_SEC', 5))  # number of seconds to keep in buffer
+  # spill the pre-roll beyond preroll_ram seconds from RAM to a ring file of this
+  # size, 0 to keep all of it in RAM. Size it for the bitrate times the pre-roll
+  preroll_disk = int(os.getenv('PYCAM_PREROLL_DISK_MB', 0)) * 1024 * 1024
+  preroll_ram = int(os.getenv('PYCAM_PREROLL_RAM_SEC', 6))
+  preroll_path = os.path.join(current_dir, 'preroll.ring')
+  # frames from one keyframe to the next, 0 for half the pre-buffer, or 2 seconds
+  # with the pre-roll on disk
+  intra_period = int(os.getenv('PYCAM_INTRA_PERIOD', 0))
+  postbuffer = int(os.getenv('PYCAM_POSTBUFFER_SEC', 5))  # number of seconds to record post end of motion
+  overlay = int(os.getenv('PYCAM_OVERLAY', 1))
+  capture_still = int(os.getenv('PYCAM_JPEG', 0))
+  jpeg_quality = int(os.getenv('PYCAM_JPEG_QUALITY', 75))
+  # pick the still image with the most motion from this many frames after detection
+  jpeg_frames = int(os.getenv('PYCAM_JPEG_FRAMES', 0))
   video_dir = os.path.join(current_dir, 'videos')
   image_dir = os.path.join(current_dir, 'images')
   video_file_pattern = '%Y-%m-%d_%H-%M-%S'  # filename pattern for time.strfime
   image_file_pattern = '%Y-%m-%d_%H-%M-%S'  # filename pattern for time.strfime
-  rotation = int(os.getenv('PYCAM_ROTATION'))
+  rotation = int(os.getenv('PYCAM_ROTATION', 0))
   # number of connected MV blocks (each 16x16 pixels) to count as a moving object
-  _area = int(os.getenv('PYCAM_DETECT_BLOCKS'))
-  _frames = int(os.getenv('PYCAM_DETECT_FRAMES'))  # number of frames which must contain movement to trigger
+  _area = int(os.getenv('PYCAM_DETECT_BLOCKS', 25))
+  _frames = int(os.getenv('PYCAM_DETECT_FRAMES', 4))  # number of frames which must contain movement to trigger
+  # analyse motion vectors on a worker thread rather than in the camera callback
+  threaded = int(os.getenv('PYCAM_DETECT_THREADED', 0))
+  # skip frames or pool MV blocks when analysis can't keep up with the frame rate
+  adaptive = int(os.getenv('PYCAM_DETECT_ADAPTIVE', 1))
+  # region of interest mask, an image or .npy file relative to this directory (see
+  # motion_mask), and whether to exclude the date and time annotation from detection
+  detect_mask = os.getenv('PYCAM_DETECT_MASK', '')
+  detect_mask_annotation = int(os.getenv('PYCAM_DETECT_MASK_ANNOTATION', 1))
+  # number of buffer snapshots that may queue up for writing to disk
+  write_queue = int(os.getenv('PYCAM_WRITE_QUEUE', 4))
+  # log motion vectors into archive files of this size in motion_vectors/, 0 to disable,
+  # keeping the most recent mv_archive_files of them
+  mv_archive = int(os.getenv('PYCAM_MV_ARCHIVE_MB', 0)) * 1024 * 1024
+  mv_archive_files = int(os.getenv('PYCAM_MV_ARCHIVE_FILES', 24))
+  mv_archive_compress = int(os.getenv('PYCAM_MV_ARCHIVE_COMPRESS', 1))
+  mv_archive_sad_shift = int(os.getenv('PYCAM_MV_ARCHIVE_SAD_SHIFT', -1))  # quantize SAD to 8 bits, -1 to keep it exact
+  mv_archive_dir = os.path.join(current_dir, 'motion_vectors')
+  # disk space for recordings and images waiting for upload, each
+  spool_size = int(os.getenv('PYCAM_SPOOL_MB', 1024)) * 1024 * 1024
+  # SQLite index of events and per-second motion statistics, relative to this
+  # directory or empty to disable, and days of statistics to keep
+  event_db = os.getenv('PYCAM_EVENT_DB', 'events.db')
+  event_series_days = int(os.getenv('PYCAM_EVENT_SERIES_DAYS', 30))
+  # shared memory name to publish the live motion field under, see motion_field.py
+  field_shm = os.getenv('PYCAM_FIELD_SHM', '')
 
   _camera = None
   _motion = None
-  _output = None
+  _output = None  # recording in progress
+  _preroll = None
+  _buffer_seconds = 0  # seconds of video in the circular buffer
+  _writer = None
+  _still = None
+  lock_time = 0.0  # longest time the circular buffer was locked by append_buffer
 
-  captures = queue.Queue()
-  images = queue.Queue()
+  captures = None  # recordings waiting for upload
+  images = None  # still images waiting for upload
+  events = None  # event store, if enabled
 
   def __enter__(self):
+    self._writer = RecordingWriter(self.write_queue)
+    self._writer.start()
+    if self.events:
+      self.events.start()
     self.start_camera()
+    if self.capture_still:
+      self._still = StillCapture(self._camera, self._motion, self.image_dir, self.images,
+                                 self.jpeg_quality, self.jpeg_frames, self.image_file_pattern)
+      self._still.start()
     threading.Thread(name="blink", target=self.blink, daemon=True).start()
     threading.Thread(name="annotate", target=self.annotate_with_datetime, args=(
         self._camera,), daemon=True).start()
+    if self._preroll is not None:
+      threading.Thread(name="preroll", target=self.spill_preroll, daemon=True).start()
     if self.overlay:
       threading.Thread(name="motion overlay",
                        target=self.motion_overlay, daemon=True).start()
@@ -63,10 +130,24 @@ class MotionRecorder(threading.Thread):
     camera = self._camera
     if camera.recording:
       camera.stop_recording()
+    self._motion.stop()
+    if self._preroll is not None:
+      self._preroll.close()
+    if self.events:
+      self._motion.series.flush()  # the last second, now that analysis has stopped
+      self.events.close()
 
   def __init__(self, overlay=False):
     super().__init__()
     self.overlay = overlay
+    self._preroll_lock = threading.Lock()
+    self.captures = Spool(self.video_dir, self.spool_size)
+    self.images = Spool(self.image_dir, self.spool_size)
+    if self.event_db:
+      self.events = EventStore(os.path.join(current_dir, self.event_db),
+                               days=self.event_series_days)
+    metrics.gauge('pycam_captures_queued', 'Recordings waiting for upload', self.captures.qsize)
+    metrics.gauge('pycam_images_queued', 'Still images waiting for upload', self.images.qsize)
 
   def __str__(self):
     if (self._motion):
@@ -113,30 +194,45 @@ class MotionRecorder(threading.Thread):
     #camera.sensor_mode = 4
     if self.overlay:
       camera.start_preview(alpha=255)
+    # the circular buffer holds the whole pre-roll, or the last few seconds of
+    # it and the rest is spilled to disk, GOP by GOP
+    self._buffer_seconds = self.prebuffer
+    intra_period = self.intra_period or self.prebuffer*self.framerate_max // 2
+    if self.preroll_disk:
+      self._preroll = preroll.PrerollStore(self.preroll_path, self.preroll_disk)
+      self._buffer_seconds = min(self.preroll_ram, self.prebuffer)
+      intra_period = self.intra_period or 2*self.framerate_max
+      if 2 * intra_period / self.framerate_max + 1 > self._buffer_seconds:
+        logging.warning("with an intra period of {0} frames, {1}s of video in RAM may not "
+                        "hold the two GOPs the pre-roll on disk needs".format(
+                            intra_period, self._buffer_seconds))
     self._stream = stream = picamera.PiCameraCircularIO(
-        camera, seconds=self.prebuffer+1, bitrate=self.bitrate)
+        camera, seconds=self._buffer_seconds+1, bitrate=self.bitrate)
+    weights = motion_mask.region_weights(
+        (self.width, self.height), self.detect_mask and os.path.join(current_dir, self.detect_mask),
+        self.detect_mask_annotation)
     self._motion = motion = MotionVectorReader(
-        camera, window=self.postbuffer*self.framerate_max, area=self.area, frames=self.frames)
+        camera, window=self.postbuffer*self.framerate_max, area=self.area, frames=self.frames,
+        threaded=self.threaded, framerate=self.framerate_max, adaptive=self.adaptive,
+        weights=weights)
+    if self.mv_archive:
+      motion.save_motion_vectors(self.mv_archive_dir, self.mv_archive, self.mv_archive_files,
+                                 self.mv_archive_sad_shift if self.mv_archive_sad_shift >= 0 else None,
+                                 self.mv_archive_compress)
+    if self.events:
+      motion.series = MotionSeries(self.events)
+    if self.field_shm:
+      motion.publish_field(self.field_shm)
     camera.start_recording(stream, motion_output=motion,
                            format='h264', profile='high', level='4.1', bitrate=self.bitrate,
-                           inline_headers=True, intra_period=self.prebuffer*self.framerate_max // 2)
+                           inline_headers=True, intra_period=intra_period)
     camera.wait_recording(1)  # give camera some time to start up
 
-  def capture_jpeg(self):
-    name = time.strftime(self.image_file_pattern)
-    tmp_path = os.path.join(self.image_dir, name+'-temp.jpg')
-    path = os.path.join(self.image_dir, name+'.jpg')
-    self._camera.capture(tmp_path, use_video_port=True, format='jpeg', quality=100)
-    img = Image.open(tmp_path)
-    img.save(path, 'JPEG', quality=75)
-    os.remove(tmp_path)
-    return path
-
   def run(self):
     """Main loop of the motion recorder. Waits for trigger from the motion detector
     async task and writes in-memory circular buffer to file every time it happens,
     until motion detection trigger. After each recording, the name of the file
-    is posted to captures queue, where whatever is consuming the recordings can
+    is posted to captures spool, where whatever is consuming the recordings can
     pick it up.
     """
     self._motion.disabled = False
@@ -150,53 +246,114 @@ class MotionRecorder(threading.Thread):
             # start a new video, then append circular buffer to it until
             # motion ends
             name = time.strftime(self.video_file_pattern)
-            path = os.path.join(self.video_dir, name+'.h264')
-            output = io.open(path, 'wb')
-            self.append_buffer(output, header=True)
+            path = os.path.join(self.video_dir, name+'.mkv')
+            written, write_time = self._writer.bytes_written, self._writer.write_time
+            self.lock_time = 0.0
+            width, height = self.width, self.height
+            if self.rotation in (90, 270):
+              width, height = height, width
+            output = MatroskaWriter(io.open(path, 'wb'), width, height, self.framerate_max)
+            with self._preroll_lock:
+              self._output = output  # also stops spilling the pre-roll
+            if not self.append_preroll(output):
+              self.append_buffer(output, header=True)
+            if self.events:
+              self._motion.series.mark()
+              self.events.start_event(path, time.time(), self._motion.trigger_index,
+                                      self._camera.exposure_speed, self._camera.analog_gain,
+                                      self._camera.digital_gain)
 
-            # Capture image in the beginning of motion
-            if self.capture_still:
-              self.images.put(self.capture_jpeg())
+            # Capture image in the beginning of motion, in the background
+            if self._still:
+              self._still.trigger()
 
             while self._motion.motion() and self._camera.recording:
-              self.wait(self.prebuffer / 2)
+              self.wait(self._buffer_seconds / 2)
               self.append_buffer(output)
 
           except picamera.PiCameraError as e:
             logging.error("while saving recording: "+e)
 
           finally:
-            output.close()
-            self._output = None
+            self._writer.submit(output.close)
+            self._writer.flush()
+            with self._preroll_lock:
+              if self._preroll is not None:
+                self._preroll.clear()  # recorded, the next pre-roll starts over
+              self._output = None
             self._camera.led = False
-
-            # Wrap h264 in mkv container with appropriate fps
-            # TODO: we have a variable framerate stream but encode this as fixed maximum fps
-            mkvpath = os.path.join(self.video_dir, name+'.mkv')
-            os.system('ffmpeg -r '+str(self.framerate_max)+' -i '+path +
-                      ' -vcodec copy '+mkvpath+' >/dev/null 2>&1')
-            os.remove(path)  # Delete original .h264 file
-            self.captures.put(mkvpath)
+            written = self._writer.bytes_written - written
+            write_time = self._writer.write_time - write_time
+            logging.debug("wrote {0} bytes at {1:.2f} MB/s, circular buffer locked for up to {2:.1f} ms".format(
+                written, written / write_time / 1e6 if write_time else 0.0, 1000 * self.lock_time))
+            self.captures.put(path)
+            recordings_total.inc()
+            if self.events:
+              self.events.end_event(path, time.time(), *self._motion.series.summary())
 
           # wait for the circular buffer to fill up before looping again
-          self.wait(self.prebuffer / 2)
+          self.wait(self._buffer_seconds / 2)
 
   def append_buffer(self, output, header=False):
-    """Flush contents of circular framebuffer to current on-disk recording.
+    """Flush contents of circular framebuffer to current recording.
+    The buffer is only locked while its frames are copied into memory, the
+    recording writer thread then muxes them to disk with their timestamps.
     """
     if header:
       header = picamera.PiVideoFrameType.sps_header
     else:
       header = None
     stream = self._stream
+    snapshot = io.BytesIO()
+    start = time.perf_counter()
     with stream.lock:
-      stream.copy_to(output, seconds=self.prebuffer, first_frame=header)
+      first, last = stream.copy_to(snapshot, seconds=self._buffer_seconds, first_frame=header)
+      if first is None or last is None:
+        frames = []
+      else:
+        frames = [frame for frame in stream.frames
+                  if first.position <= frame.position <= last.position]
       #firstframe = lastframe = next(iter(stream.frames)).index
       #for frame in stream.frames: lastframe = frame.index
       #logging.debug("write {0} to {1}".format(firstframe,lastframe))
       stream.clear()
+    locked = time.perf_counter() - start
+    self.lock_time = max(self.lock_time, locked)
+    lock_seconds.observe(locked)
+    snapshot_total.inc(snapshot.tell())
+    # split the snapshot into frames, without copying
+    data = snapshot.getbuffer()
+    frames = [(data[frame.position - first.position:frame.position - first.position + frame.frame_size],
+               frame.timestamp) for frame in frames]
+    self._writer.submit(output.write, frames)
     return output
 
+  def append_preroll(self, output):
+    """Start a recording with the pre-roll spilled to disk, linked in without
+    copying it through Python, followed by the circular buffer. Returns False
+    if there is none to start with, or it doesn't join up with the buffer."""
+    if self._preroll is None or not len(self._preroll):
+      return False
+    stream = self._stream
+    start = time.perf_counter()
+    with stream.lock:
+      frames = stream.frames
+      timestamps = [frame.timestamp for frame in frames if frame.timestamp is not None]
+      if not timestamps:
+        return False
+      segments = self._preroll.segments(timestamps[-1] - self.prebuffer * 1000000)
+      frames = [frame for frame in frames if segments and frame.index > segments[-1].index]
+      if not frames or frames[0].index != segments[-1].index + 1:
+        return False
+      data = preroll.read_frames(stream, frames)
+      stream.clear()
+    locked = time.perf_counter() - start
+    self.lock_time = max(self.lock_time, locked)
+    lock_seconds.observe(locked)
+    self._writer.submit(self._preroll.link, output, segments)
+    self._writer.submit(output.write, data)
+    return True
+
   def blink(self):
     """Background thread for blinking the camera LED (to signal detection).
     """
@@ -207,6 +364,19 @@ class MotionRecorder(threading.Thread):
         self._camera.led = False
       self.wait(2-time.time() % 2)  # wait up to two seconds
 
+  def spill_preroll(self):
+    """Background thread moving complete GOPs from the circular buffer to the
+    pre-roll on disk, while there is no recording in progress."""
+    while self._camera.recording:
+      with self._preroll_lock:
+        if self._output is None:
+          try:
+            preroll.spill(self._stream, self._preroll, picamera.PiVideoFrameType.sps_header)
+          except OSError as e:
+            logging.error("while spilling the pre-roll: {0}".format(e))
+            self._preroll.clear()
+      self.wait(1)
+
   def annotate_with_datetime(self, camera):
     """Background thread for annotating date and time to video.
     """
@@ -237,8 +407,11 @@ class MotionRecorder(threading.Thread):
         x = (width-w)//2+1
         h = a.shape[0]
         y = (height-h)//2+1
-        # highlight those blocks which exceed thresholds on green channel
-        buffer[y:y+h, x:x+w, 1] = a * 255
+        # highlight those blocks which exceed thresholds on green channel, in
+        # uint8 without a temporary array. The grid shrinks when MVs are pooled
+        green = buffer[:, :, 1]
+        green.fill(0)
+        np.multiply(a, 255, out=green[y:y+h, x:x+w], dtype=np.uint8)
       try:
         overlay.update(memoryview(buffer))
       except picamera.exc.PiCameraRuntimeError as e:
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+import os
+import struct
+import time
+import collections
+import numpy as np
+from motion_vector_reader import MotionVectorReader, motion_dtype, grid_shape, grid_resolution
+import motion_archive
+
+# record header of legacy motion vector dumps, written for every frame
+header = struct.Struct('>8sL?8sBBB')
+
+Frame = collections.namedtuple('Frame', ['index', 'timestamp'])
+Replay = collections.namedtuple('Replay', ['latencies', 'motion', 'triggers', 'dropped'])
+
+# synthetic scenes for benchmarking, see synthetic_motion_vectors()
+scenarios = {
+    'still': dict(objects=0),
+    'walker': dict(objects=1, size=8, speed=1.0, period=60),
+    # still for longer than the recorder's default window of 75 frames, so
+    # that every visit is an event of its own
+    'visitor': dict(objects=1, size=8, speed=1.0, period=150),
+    'busy': dict(objects=12, size=3, speed=2.0, period=20, noise=4),
+}
+
+
+class ReplayCamera(object):
+  """Stand-in for the few PiCamera attributes that MotionVectorReader uses, so
+  that recorded or synthetic motion vectors can be fed to it without a camera.
+  """
+
+  def __init__(self, resolution=(1640, 1232), framerate=10):
+    self.resolution = resolution
+    self.framerate = framerate
+    self.frame = Frame(0, 0)
+
+
+def read_motion_vectors(file):
+  """Generator over a legacy motion vector dump, as MotionVectorReader used to
+  write before motion_archive, yielding (frame index, motion, array)
+  for every frame. A truncated last record (e.g. after a power cut) is ignored.
+  """
+  with open(file, 'rb') as f:
+    while True:
+      record = f.read(header.size)
+      if len(record) < header.size:
+        return
+      frameno, index, motion, mvarray, rows, cols, itemsize = header.unpack(record)
+      if frameno != b'frameno\x00' or mvarray != b'mvarray\x00':
+        raise ValueError("{0}: not a motion vector record at offset {1}".format(
+            file, f.tell() - header.size))
+      if itemsize != motion_dtype.itemsize:
+        raise ValueError("{0}: unexpected motion vector size {1}".format(file, itemsize))
+      data = f.read(rows * cols * itemsize)
+      if len(data) < rows * cols * itemsize:
+        return
+      yield index, motion, np.frombuffer(data, dtype=motion_dtype).reshape((rows, cols))
+
+
+# H.264 recordings, whose MVs are decoded in software (see motion_vector_decoder)
+video_extensions = ('.h264', '.264', '.mp4', '.mkv', '.mov')
+
+
+def read_frames(file):
+  """Generator over a motion vector archive (a file or a directory of them, see
+  motion_archive), a legacy motion vector dump or an H.264 recording, yielding
+  (frame index, array) for every frame."""
+  if os.path.isdir(file) or file.endswith(motion_archive.extension):
+    for path in motion_archive.archive_files(file):
+      archive = motion_archive.Archive(path)
+      for index, _, a in archive:
+        yield index, a
+      archive.close()
+  elif os.path.splitext(file)[1] in video_extensions:
+    from motion_vector_decoder import decode_motion_vectors
+    for index, _, a in decode_motion_vectors(file):
+      yield index, a
+  else:
+    for index, _, a in read_motion_vectors(file):
+      yield index, a
+
+
+def synthetic_motion_vectors(width=1640, height=1232, frames=300, objects=1, size=6,
+                             speed=1.0, period=50, noise=2, sad=100, vector=20, seed=0):
+  """Generator of synthetic motion vector arrays: a noisy still background with
+  a number of square objects (size in MV blocks) moving across it at the given
+  speed (blocks per frame) with motion vectors of the given length. Every
+  object is visible for period frames, then disappears for as long, so that the
+  detector sees motion start and end.
+  """
+  rng = np.random.default_rng(seed)
+  rows, cols = grid_shape(width, height)
+  positions = rng.uniform((0, 0), (rows, cols - 1), size=(objects, 2))
+  velocities = rng.uniform(-speed, speed, size=(objects, 2))
+  phases = rng.integers(0, 2 * period, size=objects)
+  for index in range(frames):
+    a = np.empty((rows, cols), dtype=motion_dtype)
+    a['x'] = rng.integers(-noise, noise + 1, size=(rows, cols))
+    a['y'] = rng.integers(-noise, noise + 1, size=(rows, cols))
+    a['sad'] = rng.poisson(sad, size=(rows, cols)).clip(0, 65535)
+    for i in range(objects):
+      positions[i] = (positions[i] + velocities[i]) % (rows, cols - 1)
+      if (index + phases[i]) // period % 2:
+        continue
+      y, x = positions[i].astype(int)
+      block = a[y:y + size, x:x + size]
+      direction = velocities[i] / max(np.hypot(*velocities[i]), 1e-6)
+      block['x'] = direction[1] * vector
+      block['y'] = direction[0] * vector
+      block['sad'] = 4 * sad
+    yield a
+
+
+def replay(motion, frames, speed=None):
+  """Feeds motion vector arrays through motion.analyse(), as fast as possible or
+  paced at speed times the camera frame rate, updating the frame index of the
+  camera stand-in as a recording would. Returns the latency (in seconds) of
+  every analyse() call, the motion result of every frame (always False if the
+  reader is threaded), the frame indexes at which the motion trigger was set and
+  the number of frames dropped by a threaded reader.
+  """
+  latencies = []
+  results = []
+  triggers = []
+  triggered = motion.motion()
+  dropped = motion.dropped
+  begin = time.perf_counter()
+  for index, a in enumerate(frames):
+    timestamp = int(index * 1000000 / motion.camera.framerate)
+    if speed:
+      time.sleep(max(begin + timestamp / 1000000 / speed - time.perf_counter(), 0))
+    motion.camera.frame = Frame(index, timestamp)
+    start = time.perf_counter()
+    results.append(bool(motion.analyse(a)))
+    latencies.append(time.perf_counter() - start)
+    if motion.motion() and not triggered:
+      triggers.append(index)
+    triggered = motion.motion()
+  motion.drain()
+  return Replay(np.array(latencies), np.array(results, dtype=bool), triggers,
+                motion.dropped - dropped)
+
+
+def replay_reader(shape, framerate=10, **kwargs):
+  """Create a MotionVectorReader on a camera stand-in for the given MV array
+  shape. Keyword arguments are passed on to MotionVectorReader."""
+  motion = MotionVectorReader(ReplayCamera(grid_resolution(shape), framerate),
+                              framerate=framerate, **kwargs)
+  motion.clear()
+  return motion
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+"""Software motion vector source for cameras other than the Pi camera: decodes
+any H.264 stream or file (USB camera, RTSP URL, recording) with libavcodec,
+which exports the motion vectors of every frame, and converts them into the
+16x16 macro block array that MotionVectorReader.analyse() consumes.
+
+  python3 motion_vector_decoder.py clip.h264                    # extraction speed
+  python3 motion_vector_decoder.py rtsp://camera/stream --output motion_vectors
+"""
+
+import time
+import argparse
+import logging
+import numpy as np
+import av
+from motion_vector_reader import motion_dtype
+from motion_archive import ArchiveWriter
+
+
+def macro_blocks(vectors, shape, sad=100, out=None):
+  """Average libavcodec's motion vectors, given per (sub-)partition, over the
+  16x16 macro blocks they belong to. Vectors stay in the quarter pixel units
+  they are coded in. Vectors into future frames (B-frames) are reversed to
+  point the same way as those into the past.
+
+  libavcodec doesn't export the residual, so sad is a constant stand-in for it:
+  it sets the noise floor, making motion vectors count once they are about
+  (sad/16 + 1) long. In streams with B-frames, the vectors of P-frames span
+  several frames and are longer accordingly."""
+  rows, cols = shape
+  if out is None:
+    out = np.empty(shape, dtype=motion_dtype)
+  out['sad'] = sad
+  if vectors is None or not len(vectors):
+    out['x'] = out['y'] = 0
+    return out
+  block = (np.clip(vectors['dst_y'] >> 4, 0, rows - 1) * cols +
+           np.clip(vectors['dst_x'] >> 4, 0, cols - 1))
+  weight = vectors['w'].astype(np.float32) * vectors['h']
+  weight *= np.where(vectors['source'] > 0, -1.0, 1.0) * 4 / vectors['motion_scale']
+  area = np.bincount(block, np.abs(weight), minlength=rows * cols)
+  area[area == 0] = 1
+  for field, motion in (('x', 'motion_x'), ('y', 'motion_y')):
+    total = np.bincount(block, weight * vectors[motion], minlength=rows * cols)
+    out[field] = np.clip(np.rint(total / area), -128, 127).reshape(shape)
+  return out
+
+
+def annexb(data, length_size=4):
+  """Convert length prefixed NAL units, as stored in MP4 and Matroska, into an
+  Annex B byte stream."""
+  units = []
+  offset = 0
+  while offset + length_size <= len(data):
+    length = int.from_bytes(data[offset:offset + length_size], 'big')
+    offset += length_size
+    units.append(b'\x00\x00\x00\x01' + bytes(data[offset:offset + length]))
+    offset += length
+  return b''.join(units)
+
+
+def parameter_sets(extradata):
+  """SPS and PPS from a stream's extradata as Annex B, and the NAL unit length
+  size of its packets, or None if they are Annex B already."""
+  if not extradata:
+    return b'', None
+  if extradata[0] != 1:
+    return bytes(extradata), None
+  # avcC: version, profile, compatibility, level, length size, SPS count, SPSs, PPS count, PPSs
+  length_size = (extradata[4] & 3) + 1
+  units = []
+  offset = 5
+  for mask in (0x1f, 0xff):
+    count = extradata[offset] & mask
+    offset += 1
+    for _ in range(count):
+      length = int.from_bytes(extradata[offset:offset + 2], 'big')
+      units.append(b'\x00\x00\x00\x01' + bytes(extradata[offset + 2:offset + 2 + length]))
+      offset += 2 + length
+  return b''.join(units), length_size
+
+
+def read_stream(source, sad=100, threads=0, options=None):
+  """Generator over the packets of an H.264 stream along with the motion
+  vectors of the frames decoded from them. Yields (packet data as Annex B,
+  keyframe, timestamp in us or None, list of (frame index, timestamp in us,
+  array)) for every packet. Keyframes carry the parameter sets, so that a
+  recording can start at any of them. Frames without motion vectors (intra
+  frames) repeat those of the previous frame, so that a run of motion isn't
+  broken by a keyframe. Only the motion vectors are of interest, so the decoder
+  skips the loop filter and never converts the pictures.
+
+  Parameters
+  ----------
+  source : file name or URL that libavformat can open
+  sad : noise floor standing in for the SAD, see macro_blocks()
+  threads : decoder threads, 0 to use all cores
+  options : options for libavformat, e.g. {'rtsp_transport': 'tcp'}
+  """
+  container = av.open(source, options=options or {})
+  try:
+    stream = container.streams.video[0]
+    context = stream.codec_context
+    context.options = {'flags2': '+export_mvs', 'skip_loop_filter': 'all'}
+    context.thread_type = 'AUTO'
+    context.thread_count = threads
+    headers, length_size = parameter_sets(context.extradata)
+    shape = None
+    previous = None
+    index = 0
+    for packet in container.demux(stream):
+      decoded = []
+      for frame in context.decode(packet):
+        if shape is None:
+          # the same grid as the Pi camera's, including its extra column
+          shape = ((frame.height + 15) // 16, (frame.width + 15) // 16 + 1)
+        vectors = frame.side_data.get('MOTION_VECTORS')
+        if vectors is not None:
+          previous = macro_blocks(vectors.to_ndarray(), shape, sad)
+        elif previous is None:
+          previous = macro_blocks(None, shape, sad)
+        timestamp = int(frame.time * 1000000) if frame.time is not None else None
+        decoded.append((index, timestamp, previous))
+        index += 1
+      if packet.size == 0:
+        data = b''  # flushing the decoder at the end of the stream
+      elif length_size:
+        data = annexb(bytes(packet), length_size)
+      else:
+        data = bytes(packet)
+      if packet.is_keyframe and headers and b'\x00\x00\x01\x67' not in data[:64]:
+        data = headers + data
+      timestamp = int(packet.pts * packet.time_base * 1000000) if packet.pts is not None else None
+      yield data, packet.is_keyframe, timestamp, decoded
+  finally:
+    container.close()
+
+
+def decode_motion_vectors(source, sad=100, threads=0, options=None):
+  """Generator over the motion vectors of an H.264 stream, yielding (frame
+  index, timestamp in us, array) for every frame. See read_stream()."""
+  for _, _, _, decoded in read_stream(source, sad, threads, options):
+    yield from decoded
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('source', help="H.264 file or stream URL")
+  parser.add_argument('--output', help="save motion vectors into archive files in this directory")
+  parser.add_argument('--sad', type=int, default=100, help="noise floor standing in for the SAD")
+  parser.add_argument('--threads', type=int, default=0, help="decoder threads, 0 for all cores")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+
+  output = ArchiveWriter(args.output, compress=True) if args.output else None
+  start = time.perf_counter()
+  count = 0
+  try:
+    for index, timestamp, a in decode_motion_vectors(args.source, args.sad, args.threads):
+      if output:
+        output.write(a, index, timestamp)
+      count += 1
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if output:
+      output.close()
+  elapsed = time.perf_counter() - start
+  logging.info("decoded motion vectors of {0} frames in {1:.1f}s, {2:.0f} fps".format(
+      count, elapsed, count / elapsed if elapsed else 0.0))
+
+
+if __name__ == '__main__':
+  main()
@@ -1,21 +1,47 @@
 import threading
-import picamerax as picamera
-import picamerax.array
 import logging
+import time
 import numpy as np
 from scipy import ndimage
-from collections import deque
+import metrics
 
-# a no-op to handle the profile decorator -- or uncomment the profile import below
-def profile(func):
-  def func_wrapper(*args, **kwargs):
-    return func(*args, **kwargs)
-  return func_wrapper
+try:
+  import picamerax as picamera
+  import picamerax.array
+  PiMotionAnalysis = picamera.array.PiMotionAnalysis
+  motion_dtype = picamera.array.motion_dtype
+except ImportError:
+  # picamerax needs the MMAL libraries of the Pi. Elsewhere, the detector can
+  # still be driven offline, e.g. by motion_replay for benchmarking
+  motion_dtype = np.dtype([('x', np.int8), ('y', np.int8), ('sad', np.uint16)])
 
-#from profilehooks import profile
+  class PiMotionAnalysis(object):
+    def __init__(self, camera, size=None):
+      self.camera = camera
+      self.size = size
 
 
-class MotionVectorReader(picamera.array.PiMotionAnalysis):
+def grid_shape(width, height):
+  """Shape of the motion vector array for a given resolution, including the
+  extra column of macro blocks that the camera always outputs."""
+  return (height + 15) // 16, (width + 15) // 16 + 1
+
+
+def grid_resolution(shape):
+  """A resolution for an MV array shape, the inverse of grid_shape()."""
+  rows, cols = shape
+  return 16 * (cols - 1), 16 * rows
+
+
+analyse_seconds = metrics.histogram('pycam_analyse_seconds', 'Time to analyse a frame of motion vectors')
+label_seconds = metrics.histogram('pycam_label_seconds', 'Time to label connected areas of motion')
+components = metrics.gauge('pycam_motion_components', 'Connected areas of motion in the last labelled frame')
+largest_area = metrics.gauge('pycam_motion_largest_blocks', 'MV blocks in the largest area of motion in the last frame')
+overruns_total = metrics.counter('pycam_analyse_overruns_total', 'Frames whose analysis took longer than the frame budget')
+dropped_total = metrics.counter('pycam_analyse_dropped_total', 'Frames dropped because the analysis worker fell behind')
+
+
+class MotionVectorReader(PiMotionAnalysis):
   """This is a hardware-assisted motion detector, able to process a high-definition
   video stream (but not full HD, and at 10 fps only) on a Raspberry Pi 1, despite
   being implemented in Python. How is that possible?! The magic is in computing
@@ -27,13 +53,21 @@ class MotionVectorReader(picamera.array.PiMotionAnalysis):
   frames = 0
   window = 0
   camera = None
-  trigger = threading.Event()
+  trigger = None  # set while there is motion, see set() and clear()
   output = None
+  weights = None  # weight of every MV block, see motion_mask
+  series = None  # event_store.MotionSeries accounting every analysed frame
+  trigger_index = None  # camera frame index at which the trigger was last set
+  publisher = None  # motion_field.FieldPublisher of the live motion field
+  _field_name = None
 
   def __str__(self):
-    return "sensitivity {0}/{1}".format(self.area, self.frames)
+    decimate, pool = self.levels[self.level]
+    return "sensitivity {0}/{1}".format(self.area, self.frames) + \
+        (" 1/{0}".format(decimate) if decimate > 1 else "") + (" 2x2" if pool else "")
 
-  def __init__(self, camera, window=10, area=25, frames=4):
+  def __init__(self, camera, window=10, area=25, frames=4, threaded=False, slots=8,
+               framerate=10, adaptive=False, weights=None):
     """Initialize motion vector reader
 
     Parameters
@@ -41,17 +75,42 @@ class MotionVectorReader(picamera.array.PiMotionAnalysis):
     camera : PiCamera
     size : minimum number of connected MV blocks (each 16x16 pixels) to qualify for movement
     frames : minimum number of frames to contain movement to quality
+    threaded : analyse frames on a worker thread instead of the camera callback
+    slots : number of frames the worker may fall behind before frames are dropped
+    framerate : frame rate of the camera, giving the time budget per frame
+    adaptive : shed analysis load when frames take too long to analyse
+    weights : uint8 weight of every MV block from motion_mask, 0 to exclude a
+              block and 255 for full sensitivity, or None to weigh all fully
     """
     super(type(self), self).__init__(camera)
     self.camera = camera
     self.area = area
     self.frames = frames
     self.window = window
-    self._last_frames = deque(maxlen=window)
+    self.threaded = threaded
+    self._slots = slots
+    self.budget = 1.0 / framerate
+    self.adaptive = adaptive
+    self.weights = weights
+    self.trigger = threading.Event()
+    if threaded:
+      self._ready = threading.Condition()
+      self._worker = threading.Thread(name="motion analysis", target=self._work, daemon=True)
+      self._worker.start()
     logging.debug("motion detection sensitivity: "+str(self))
 
-  def save_motion_vectors(self, file):
-    self.output = open(file, "ab")
+  def save_motion_vectors(self, directory, max_bytes=64 << 20, max_files=0, sad_shift=None,
+                          compress=False):
+    """Log the motion vectors of every analysed frame into rotating archive
+    files in directory, see motion_archive.ArchiveWriter."""
+    from motion_archive import ArchiveWriter
+    self.output = ArchiveWriter(directory, max_bytes, max_files, sad_shift, compress)
+
+  def publish_field(self, name, slots=4):
+    """Publish the motion field of every analysed frame into shared memory
+    under name, for other processes to read with motion_field.FieldReader."""
+    self._field_name = name
+    self._field_slots = slots
 
   def set(self):
     self.trigger.set()
@@ -65,27 +124,259 @@ class MotionVectorReader(picamera.array.PiMotionAnalysis):
   def wait(self, timeout=0.0):
     return self.trigger.wait(timeout)
 
+  # ring of frames waiting for the analysis worker, filled by the camera callback
+  threaded = False
+  overruns = 0  # frames which arrived while the worker was still busy
+  dropped = 0  # frames which were not analysed because the ring was full
+  _ring = None
+  _head = _tail = _pending = 0
+  _stopping = False
+  _dropped_logged = 0.0
+
+  def _enqueue(self, a):
+    """Copy a motion vector frame into the next free ring slot and return
+    immediately, so the camera callback is never held up by analysis."""
+    if self._ring is None or self._ring.shape[1:] != a.shape:
+      self._ring = np.zeros((self._slots,) + a.shape, dtype=a.dtype)
+      self._indexes = np.zeros(self._slots, dtype=np.int64)
+      self._timestamps = [None] * self._slots
+    if self._pending:
+      self.overruns += 1
+    if self._pending >= self._slots:
+      self.dropped += 1
+      dropped_total.inc()
+      if time.monotonic() - self._dropped_logged > 1:
+        self._dropped_logged = time.monotonic()
+        logging.warning("motion analysis is falling behind, dropped {0} of {1} late frames".format(
+            self.dropped, self.overruns))
+      return
+    # only this thread writes the tail slot, the worker only reads pending slots
+    slot = self._tail
+    np.copyto(self._ring[slot], a)
+    self._indexes[slot] = self.camera.frame.index
+    self._timestamps[slot] = self.camera.frame.timestamp
+    self._tail = (slot + 1) % self._slots
+    with self._ready:
+      self._pending += 1
+      self._ready.notify_all()
+
+  def _work(self):
+    """Background thread analysing frames from the ring in order."""
+    while True:
+      with self._ready:
+        while not self._pending and not self._stopping:
+          self._ready.wait()
+        if not self._pending:
+          return
+      slot = self._head
+      self.detect(self._ring[slot], self._indexes[slot], self._timestamps[slot])
+      self._head = (slot + 1) % self._slots
+      with self._ready:
+        self._pending -= 1
+        self._ready.notify_all()
+
+  def drain(self, timeout=None):
+    """Wait until the worker has analysed all queued frames."""
+    if self.threaded:
+      with self._ready:
+        return self._ready.wait_for(lambda: not self._pending, timeout)
+    return True
+
+  def stop(self):
+    """Stop the analysis worker once it has analysed all queued frames, and
+    close the motion vector archive and the shared motion field."""
+    if self.threaded:
+      with self._ready:
+        self._stopping = True
+        self._ready.notify_all()
+      self._worker.join()
+    if self.output:
+      self.output.close()
+    if self.publisher:
+      self.publisher.close()
+
   disabled = False
-  _last_frames = deque(maxlen=10)
+  largest = 0
+  # motion repetition: length of the current run of motion frames, and the number
+  # of frames since motion was last seen and since a run of self.frames ended
+  _run = 0
+  _since_motion = _since_repeated = 1 << 30
+  # per-block state and scratch buffers, allocated once for the MV array shape
   noise = None
+  magnitude = None
+  mask = None
+  field = None
+  _scratch = None
+  _include = None  # blocks not excluded, if all weights are 0 or 255
+  _scale = None  # weights, if there are any in between
+
+  _buffers = None
+  _warmup = 0  # frames left before motion counts again, see _switch()
+  index = None  # camera frame index of the last analysed frame
+
+  def _switch(self, a, shift):
+    """Switch to the per-block buffers for the MV grid of a. A noise field
+    starting from zero would let almost any MV count as motion until it has
+    built up. So when load shedding changes the grid, the noise field of the
+    grid analysed so far is carried over, pooled down or repeated up to fit,
+    and motion only counts again after a run of self.frames frames. A first
+    noise field starts at the SAD of a, where it settles in a still scene, and
+    motion only counts once the field had 2**shift frames to settle."""
+    previous = self.noise
+    self._allocate(a.shape)
+    if previous is None:
+      np.copyto(self.noise, a['sad'], casting='unsafe')
+      self._warmup = 1 << shift
+      return
+    rows, cols = a.shape
+    if previous.shape[0] > rows:
+      # to the 2x2 pooled grid, as _pool() does with the MVs
+      p = previous[:2 * rows, :2 * cols]
+      np.add(p[0::2, 0::2], p[0::2, 1::2], out=self.noise)
+      self.noise += p[1::2, 0::2]
+      self.noise += p[1::2, 1::2]
+      self.noise >>= 2
+    else:
+      # back to the full grid, each pooled block standing for the 2x2 blocks
+      # it was pooled from, the last ones for an odd row or column left out
+      np.copyto(self.noise, previous[np.ix_(np.minimum(np.arange(rows) // 2, previous.shape[0] - 1),
+                                            np.minimum(np.arange(cols) // 2, previous.shape[1] - 1))])
+    self._warmup = max(self._warmup, self.frames)
+
+  def _allocate(self, shape):
+    """Switch to the per-block buffers for an MV array shape, allocating them
+    on first use. The full and the pooled grid each keep their own buffers,
+    and block weights, which are worked out once per grid."""
+    if self._buffers is None:
+      self._buffers = {}
+    if shape not in self._buffers:
+      self._buffers[shape] = (
+          np.zeros(shape, dtype=np.int32),  # noise
+          np.zeros(shape, dtype=np.int32),  # squared MV length
+          np.zeros(shape, dtype=bool),  # mask
+          np.zeros(shape, dtype=np.int32),  # scratch
+          np.zeros(shape, dtype=np.int32)) + self._grid_weights(shape)  # labels, weights
+    self.noise, self.magnitude, self.mask, self._scratch, self._labels, self._include, \
+        self._scale = self._buffers[shape]
+
+  def _grid_weights(self, shape):
+    """Block weights for an MV grid shape, averaged over 2x2 blocks for the
+    pooled grid, as an include mask if there are none but 0 and 255, or as
+    int32 factors otherwise."""
+    weights = self.weights
+    if weights is None:
+      return None, None
+    if weights.shape != shape:
+      # pooled like the MVs, see _pool()
+      rows, cols = weights.shape[0] // 2, weights.shape[1] // 2
+      w = weights[:2 * rows, :2 * cols].astype(np.int32)
+      weights = (w[0::2, 0::2] + w[0::2, 1::2] + w[1::2, 0::2] + w[1::2, 1::2]) >> 2
+      if weights.shape != shape:
+        raise ValueError("weights of shape {0} don't fit motion vectors of shape {1}".format(
+            self.weights.shape, shape))
+    if np.isin(weights, (0, 255)).all():
+      return weights > 0, None
+    return None, weights.astype(np.int32)
+
+  def _repeat(self, motion, count=1):
+    """Track motion repetition in O(1) per frame instead of scanning a window
+    of past frames for the longest run. An analysed frame may stand for several
+    camera frames when frames are skipped."""
+    if motion:
+      self._run += count
+      self._since_motion = 0
+    else:
+      self._run = 0
+      self._since_motion += count
+    self._since_repeated += count
+    if self._run >= self.frames:
+      self._since_repeated = 0
+
+  # adaptive load shedding: analyse every Nth frame only, and/or on a grid of
+  # 2x2 pooled macro blocks. Step up a level while analysis takes more than
+  # load_high of the frame budget, and back down when it takes less than load_low
+  levels = ((1, False), (2, False), (2, True), (4, True))
+  level = 0
+  adaptive = False
+  budget = 0.1
+  load_high = 0.5
+  load_low = 0.125
+  _cost = None  # moving average of analysis time per camera frame
+  _held = 0  # frames analysed since the last level change
+  _pooled = None
+
+  def _pool(self, a):
+    """Average MVs and SAD over 2x2 macro blocks into a preallocated array."""
+    rows, cols = a.shape[0] // 2, a.shape[1] // 2
+    if self._pooled is None or self._pooled.shape != (rows, cols):
+      self._pooled = np.zeros((rows, cols), dtype=a.dtype)
+      self._pool_sum = np.zeros((rows, cols), dtype=np.int32)
+    total = self._pool_sum
+    for field in ('x', 'y', 'sad'):
+      v = a[field][:2 * rows, :2 * cols]
+      np.add(v[0::2, 0::2], v[0::2, 1::2], out=total, dtype=np.int32)
+      total += v[1::2, 0::2]
+      total += v[1::2, 1::2]
+      total >>= 2
+      self._pooled[field] = total
+    return self._pooled
+
+  def _adapt(self, cost):
+    """Update the average analysis cost per camera frame and change the load
+    shedding level if it is out of bounds."""
+    decimate, pool = self.levels[self.level]
+    cost /= decimate
+    self._cost = cost if self._cost is None else 0.9 * self._cost + 0.1 * cost
+    self._held += 1
+    if self._held < 10:
+      return
+    cost, level = self._cost, self.level
+    if cost > self.load_high * self.budget and level + 1 < len(self.levels):
+      self.level += 1
+      logging.warning("motion analysis takes {0:.1f} ms per frame, shedding load: {1}".format(
+          1000 * cost, self))
+    elif cost < self.load_low * self.budget and level > 0:
+      self.level -= 1
+      logging.info("motion analysis takes {0:.1f} ms per frame, restoring: {1}".format(
+          1000 * cost, self))
+    if level != self.level:
+      self._cost = None
+      self._held = 0
 
-  @profile
   def analyse(self, a):
+    """Called by the camera for every frame of motion vectors. Analyses the frame
+    right away, or hands it to the analysis worker if running threaded.
+    """
+    decimate = self.levels[self.level][0]
+    if decimate > 1 and self.camera.frame.index % decimate:
+      return
+    if self.threaded:
+      self._enqueue(a)
+    else:
+      return self.detect(a)
+
+  def detect(self, a, index=None, timestamp=None):
     """Runs once per frame on a 16x16 motion vector block buffer (about 5000 values).
     Must be faster than frame rate (max 100 ms for 10 fps stream).
     Sets self.trigger Event to trigger capture.
     """
 
     if self.disabled:
-      self._last_frames.append(False)
+      self._repeat(False)
       return
 
-    import struct
+    start = time.perf_counter()
+    if index is None:
+      index = self.camera.frame.index
+      timestamp = self.camera.frame.timestamp
+    # number of camera frames this one stands for, if frames were skipped or dropped
+    step = 1
+    if self.index is not None:
+      step = min(max(index - self.index, 1), max(self.window, 1))
+    self.index = index
+
     if self.output:
-      self.output.write(struct.pack('>8sL?8sBBB',
-                                    b'frameno\x00', self.camera.frame.index, self.motion(),
-                                    b'mvarray\x00', a.shape[0], a.shape[1], a[0].itemsize))
-      self.output.write(a)
+      self.output.write(a, index, timestamp, self.motion())
 
     # the motion vector array we get from the camera contains three values per
     # macroblock: the X and Y components of the inter-block motion vector, and
@@ -95,28 +386,71 @@ class MotionVectorReader(picamera.array.PiMotionAnalysis):
     # can use it in a decay function to reduce sensitivity to noise on a per-block
     # basis
 
-    # accumulate and decay SAD field
-    noise = self.noise
-    if not noise:
-      noise = np.zeros(a.shape, dtype=np.short)
-    shift = max(self.window.bit_length()-2, 0)
-    noise -= (noise >> shift) + 1  # decay old noise
-    noise = np.add(noise, a['sad'] >> shift).clip(0)
-
-    # then look for motion vectors exceeding the length of the current mask
-    a = np.sqrt(
-        np.square(a['x'].astype(np.float)) +
-        np.square(a['y'].astype(np.float))
-    ).clip(0, 255).astype(np.uint8)
-    self.field = a
+    if self._field_name and self.publisher is None:
+      from motion_field import FieldPublisher
+      self.publisher = FieldPublisher(self._field_name, a.shape, self._field_slots)
+
+    decimate, pool = self.levels[self.level]
+    area = self.area
+    if pool:
+      a = self._pool(a)
+      area = (area + 3) // 4
+
+    # accumulate and decay SAD field, in place so that it persists across frames
+    shift = max((self.window // decimate).bit_length()-2, 0)
+    if self.noise is None or self.noise.shape != a.shape:
+      self._switch(a, shift)
+    noise, magnitude, mask, scratch = self.noise, self.magnitude, self.mask, self._scratch
+    np.right_shift(noise, shift, out=scratch)
+    noise -= scratch
+    noise -= 1  # decay old noise
+    np.right_shift(a['sad'], shift, out=scratch)
+    noise += scratch
+    np.maximum(noise, 0, out=noise)
+
+    # then look for motion vectors exceeding the length of the current mask.
+    # Compare squared lengths in integers instead of taking the square root:
+    # floor(sqrt(m)) > t is the same as m >= (t+1)**2
+    np.multiply(a['x'], a['x'], out=magnitude, dtype=np.int32)
+    np.multiply(a['y'], a['y'], out=scratch, dtype=np.int32)
+    magnitude += scratch
 
     # look for the largest continuous area in picture that has motion
     # every motion vector exceeding current noise field
-    mask = (a > (noise >> 4))
-    labels, count = ndimage.label(mask)  # label all motion areas
-    # number of MV blocks per area
-    sizes = ndimage.sum(mask, labels, range(count + 1))
-    largest = np.sort(sizes)[-1]  # what's the size of the largest area
+    np.right_shift(noise, 4, out=scratch)
+    scratch += 1
+    if self._scale is not None:
+      # weighted blocks: magnitude * weight >= threshold * 255. No squared MV
+      # length reaches 182**2, and capping there keeps the products in range
+      np.minimum(scratch, 182, out=scratch)
+      np.multiply(scratch, scratch, out=scratch)
+      scratch *= 255
+      # weighted in the label buffer, which isn't needed until labelling, so
+      # that the squared MV lengths stay as they are for the motion field
+      np.multiply(magnitude, self._scale, out=self._labels)
+      np.greater_equal(self._labels, scratch, out=mask)
+    else:
+      np.multiply(scratch, scratch, out=scratch)
+      np.greater_equal(magnitude, scratch, out=mask)
+    if self._include is not None:
+      mask &= self._include  # excluded blocks never move, nor get labelled
+    self.field = mask
+
+    # no need to label anything if there aren't enough moving blocks in total
+    # to make up a single area of the minimum size (areas that small aren't
+    # measured, largest stays 0)
+    largest = 0
+    moving = np.count_nonzero(mask)
+    if moving >= max(area, 1):
+      labelling = time.perf_counter()
+      count = ndimage.label(mask, output=self._labels)  # label all motion areas
+      # number of MV blocks per area, label 0 being the background
+      sizes = np.bincount(self._labels.ravel())
+      largest = sizes[1:].max()  # what's the size of the largest area
+      label_seconds.observe(time.perf_counter() - labelling)
+      components.set(count)
+    self.largest = largest
+    largest_area.set(largest)
 
     # Do some extra work to clean up the preview overlay. Remove all but the largest
     # motion region, and even that if it's just one MV block (considered noise)
@@ -129,24 +463,32 @@ class MotionVectorReader(picamera.array.PiMotionAnalysis):
     # picture in the future for auto-adaptive motion detector
 
     # does that area size exceed the minimum motion threshold?
-    motion = (largest >= self.area)
-    # then consider motion repetition
-    self._last_frames.append(motion)
-
-    def count_longest(a, value):
-      ret = i = 0
-      while i < len(a):
-        for j in range(0, len(a)-i):
-          if a[i+j] != value:
-            break
-          ret = max(ret, j+1)
-        i += j+1
-      return ret
-    longest_motion_sequence = count_longest(self._last_frames, True)
-
-    if longest_motion_sequence >= self.frames:
+    motion = (largest >= area)
+    if self._warmup:
+      # the noise field is still settling, see _switch()
+      self._warmup -= 1
+      motion = False
+    # then consider motion repetition: is there a run of self.frames motion
+    # frames within the last self.window frames?
+    self._repeat(motion, step)
+
+    if self._since_repeated <= self.window - self.frames:
+      if not self.trigger.is_set():
+        self.trigger_index = index
       self.set()
-    elif longest_motion_sequence < 1:
+    elif self._since_motion >= self.window:
       # clear motion flag once motion has ceased entirely
       self.clear()
+    if self.series:
+      self.series.add(moving, largest, motion)
+    if self.publisher:
+      self.publisher.publish(index, timestamp, magnitude, mask, noise, largest, moving, motion,
+                             self.trigger.is_set(), self.level)
+
+    cost = time.perf_counter() - start
+    analyse_seconds.observe(cost)
+    if cost > self.budget:
+      overruns_total.inc()
+    if self.adaptive:
+      self._adapt(cost)
     return motion
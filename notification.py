@@ -1,35 +1,87 @@
 #!/usr/bin/python3
 
 import os
+import time
+import random
 import datetime
-import telegram
+import collections
+import concurrent.futures
 import traceback
 import threading
 import logging
-import dropbox
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
+from metadata_cache import MetadataCache
+import metrics
 
-class Notification:
 
-  def __init__(self):
-    self.tbot = None
-    self.gdrive = None
-    self.dbx = None
+upload_seconds = metrics.histogram('pycam_upload_seconds', 'Time to upload a recording',
+                                   metrics.duration_buckets)
+upload_failures = metrics.counter('pycam_upload_failures_total', 'Recordings whose upload failed')
+setup_seconds = metrics.gauge('pycam_notification_setup_seconds', 'Time to set up all notification backends')
+
+# Upload and messaging services are backends, registered in order of preference:
+# recordings go to the first configured uploader, messages to every configured
+# messenger. Only configured backends are set up, and their client libraries,
+# which take seconds and tens of MB to import on a Pi Zero, only imported then.
+backends = collections.OrderedDict()
+
+
+def register(cls):
+  """Class decorator adding a backend to the registry."""
+  backends[cls.name] = cls
+  return cls
+
+
+def retry(func, *args, attempts=5, backoff=2.0, **kwargs):
+  """Call func, retrying with exponential backoff (and some jitter) when it
+  raises. The last error is raised once all attempts have failed."""
+  for attempt in range(attempts):
+    try:
+      return func(*args, **kwargs)
+    except Exception as e:
+      if attempt + 1 >= attempts:
+        raise
+      delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+      logging.warning('%s failed (%s), retrying in %.1fs' % (getattr(func, '__name__', func), e, delay))
+      time.sleep(delay)
+
+
+class Backend(object):
+  """Base of upload and messaging backends. setup() imports the client library
+  and connects, and runs on the setup thread of Notification."""
+
+  name = None
+  uploads = False  # implements upload_video()
+  messages = False  # implements send_message() and send_image()
+
+  def __init__(self, notification):
+    self.notification = notification
+
+  @classmethod
+  def configured(cls):
+    return False
+
+  def setup(self):
+    pass
 
-    if os.getenv('PYCAM_TELEGRAM_TOKEN'):
-      self.tbot = telegram.Bot(os.getenv('PYCAM_TELEGRAM_TOKEN'))
 
-    if int(os.getenv('PYCAM_UPLOAD_GDRIVE')):
-      self.gdrive = self.setup_gdrive()
+@register
+class GoogleDrive(Backend):
+  name = 'gdrive'
+  uploads = True
 
-    if int(os.getenv('PYCAM_UPLOAD_DBX')):
-      self.dbx = self.setup_dbx()
+  @classmethod
+  def configured(cls):
+    return bool(int(os.getenv('PYCAM_UPLOAD_GDRIVE', 0)))
 
-  def setup_gdrive(self):
+  def setup(self):
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from googleapiclient.discovery import build
+    from googleapiclient.http import MediaFileUpload
+    self._build = build
+    self._media = MediaFileUpload
+    self._local = threading.local()
     # Setup the Drive v3 API
     SCOPES = ['https://www.googleapis.com/auth/drive.file']
     creds = None
@@ -50,70 +102,263 @@ class Notification:
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
 
-    service = build('drive', 'v3', credentials=creds, cache_discovery=False)
-    return service
+    self._creds = creds
+    self.drive()
 
-  def setup_dbx(self):
+  def drive(self):
+    """Drive API service for the current thread, as the underlying httplib2
+    connection must not be shared between upload workers."""
+    if not hasattr(self._local, 'gdrive'):
+      # a stand-in server can be configured for testing
+      options = {'api_endpoint': os.getenv('PYCAM_GDRIVE_ENDPOINT')} if os.getenv('PYCAM_GDRIVE_ENDPOINT') else None
+      self._local.gdrive = self._build('drive', 'v3', credentials=self._creds,
+                                       cache_discovery=False, client_options=options)
+    return self._local.gdrive
+
+  def upload_video(self, path):
+    notification = self.notification
+    gdrive = self.drive()
+    key = 'gdrive:%s' % os.getenv('PYCAM_UPLOAD_DIR')
+    with notification._folders:
+      folder = notification.cache.get(key)
+      if folder is None:
+        folder = self.folder(gdrive)
+        notification.cache.put(key, folder)
+
+    try:
+      # Upload file in chunks. After a failed chunk, the next call to next_chunk
+      # asks the server how much it got and resumes from there
+      media = self._media(path, mimetype='video/mp4', chunksize=notification.chunk_size, resumable=True)
+      body = {'name': os.path.basename(path), 'parents': [folder]}
+      request = gdrive.files().create(
+          body=body, fields='id, name, webViewLink, webContentLink', media_body=media)
+      uploaded = None
+      while uploaded is None:
+        status, uploaded = retry(request.next_chunk, attempts=notification.attempts)
+    except Exception:
+      # the folder may be gone, look it up again next time
+      notification.cache.invalidate(key)
+      raise
+
+    return uploaded.get('webViewLink')
+
+  def folder(self, gdrive):
+    """ID of the upload folder on Google Drive, which is created if missing."""
+    # Find folders
+    results = retry(gdrive.files().list(pageSize=100, fields="files(id, name)",
+                                        q="mimeType = 'application/vnd.google-apps.folder' AND trashed != true").execute,
+                    attempts=self.notification.attempts)
+    files = results.get('files', [])
+    # Find PiCamera folder
+    try:
+      folder = next(x for x in files if x['name'] == os.getenv('PYCAM_UPLOAD_DIR'))
+    except StopIteration:
+      # Create PiCamera folder if not exists
+      body = {'name': os.getenv('PYCAM_UPLOAD_DIR'),
+              'mimeType': 'application/vnd.google-apps.folder'}
+      folder = gdrive.files().create(body=body, fields='id, name').execute()
+    return folder.get('id')
+
+
+@register
+class Dropbox(Backend):
+  name = 'dbx'
+  uploads = True
+
+  @classmethod
+  def configured(cls):
+    return bool(int(os.getenv('PYCAM_UPLOAD_DBX', 0)))
+
+  def setup(self):
+    import dropbox
+    self._dropbox = dropbox
     TOKEN_PATH = 'token_dbx.txt'
     with open(TOKEN_PATH, 'r') as f:
       token = f.read().strip()
-    return dropbox.Dropbox(token)
+    self.dbx = dropbox.Dropbox(token)
+
+  def upload_video(self, path):
+    notification = self.notification
+    folder = '/%s/%s' % (os.getenv('PYCAM_UPLOAD_DIR'), datetime.date.today())
+    key = 'dbx:%s' % folder
+    with notification._folders:
+      if not notification.cache.get(key):
+        try:
+          self.dbx.files_get_metadata(folder)
+        except:
+          self.dbx.files_create_folder_v2(folder)
+        notification.cache.put(key, True)
+
+    path_display = "%s/%s" % (folder, os.path.basename(path))
+    try:
+      self.upload(path, path_display)
+    except Exception:
+      notification.cache.invalidate(key)
+      raise
+    return path_display
+
+  def upload(self, path, destination):
+    """Upload a file to Dropbox in an upload session, one chunk at a time.
+    Chunks are retried, and resent from wherever the server says it got to."""
+    dropbox = self._dropbox
+    attempts, chunk_size = self.notification.attempts, self.notification.chunk_size
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+      session = retry(self.dbx.files_upload_session_start, b'', attempts=attempts)
+      cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=0)
+      commit = dropbox.files.CommitInfo(path=destination)
+
+      def send():
+        f.seek(cursor.offset)
+        chunk = f.read(chunk_size)
+        try:
+          if cursor.offset + len(chunk) >= size:
+            return self.dbx.files_upload_session_finish(chunk, cursor, commit)
+          self.dbx.files_upload_session_append_v2(chunk, cursor)
+          cursor.offset += len(chunk)
+        except dropbox.exceptions.ApiError as e:
+          error = e.error
+          if getattr(error, 'is_lookup_failed', bool)():
+            error = error.get_lookup_failed()
+          if getattr(error, 'is_incorrect_offset', bool)():
+            # the server got more or less than we thought, resume from there
+            cursor.offset = error.get_incorrect_offset().correct_offset
+          raise
+
+      while True:
+        uploaded = retry(send, attempts=attempts)
+        if uploaded is not None:
+          return uploaded
+
+
+@register
+class Telegram(Backend):
+  name = 'telegram'
+  messages = True
+
+  @classmethod
+  def configured(cls):
+    return bool(os.getenv('PYCAM_TELEGRAM_TOKEN'))
+
+  def setup(self):
+    import telegram
+    self.tbot = telegram.Bot(os.getenv('PYCAM_TELEGRAM_TOKEN'))
+
+  def send_message(self, link):
+    self.tbot.send_message(os.getenv('PYCAM_TELEGRAM_CHAT_ID'),
+                           'View Video: ' + link)
+
+  def send_image(self, image):
+    with open(image, 'rb') as photo:
+      self.tbot.send_photo(os.getenv('PYCAM_TELEGRAM_CHAT_ID'),
+                           photo=photo, caption='Motion detected')
+
+
+class Notification:
+
+  # videos are uploaded by a pool of workers, with at most twice as many videos
+  # waiting or in progress. Uploads stream the file in chunks of chunk_size
+  workers = int(os.getenv('PYCAM_UPLOAD_WORKERS', 2))
+  chunk_size = int(os.getenv('PYCAM_UPLOAD_CHUNK_MB', 4)) * 1024 * 1024
+  attempts = int(os.getenv('PYCAM_UPLOAD_ATTEMPTS', 5))
+  # resolved upload folders are cached for this long (seconds)
+  cache_ttl = int(os.getenv('PYCAM_UPLOAD_CACHE_TTL', 86400))
+
+  def __init__(self, background=False):
+    """Initialize notification
+
+    Parameters
+    ----------
+    background : set up the backends on a thread of their own, so that the
+                 caller can go on, e.g. start detecting motion. Notifications
+                 wait until they are set up
+    """
+    self.backends = []  # backends set up, in order of preference
+    self.timings = collections.OrderedDict()  # seconds to set up each backend
+    self.ready = threading.Event()
+    self._pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="upload")
+    self._slots = threading.BoundedSemaphore(2 * self.workers)
+    self._folders = threading.Lock()  # so that workers don't create a folder twice
+    self.cache = MetadataCache('metadata_cache.json', self.cache_ttl)
+    if background:
+      threading.Thread(name="notification setup", target=self.setup, daemon=True).start()
+    else:
+      self.setup()
+
+  def setup(self):
+    """Import and set up every configured backend. A backend which fails to
+    set up is logged and left out."""
+    start = time.perf_counter()
+    for name, cls in backends.items():
+      if not cls.configured():
+        continue
+      stage = time.perf_counter()
+      try:
+        backend = cls(self)
+        backend.setup()
+        self.backends.append(backend)
+      except Exception as e:
+        logging.error("while setting up notification backend '{0}': {1}".format(name, e))
+        continue
+      finally:
+        self.timings[name] = time.perf_counter() - stage
+    setup_seconds.set(time.perf_counter() - start)
+    logging.info("notification backends set up in {0:.1f}s: {1}".format(
+        time.perf_counter() - start,
+        ', '.join('{0} {1:.1f}s'.format(name, seconds) for name, seconds in self.timings.items())
+        or 'none configured'))
+    self.ready.set()
 
   def notify_image(self, image):
+    self.ready.wait()
     try:
       self.send_image(image)
+      return True
     except Exception as e:
       logging.error('While sending telegram image: %s' % e)
       traceback.print_exc()
+      return False
+
 
+  def notify_video(self, video, done=None):
+    """Upload a video and send its link from the upload pool. Blocks while the
+    pool is full. done(video, uploaded) is called once the upload has finished
+    or failed for good."""
+    self._slots.acquire()
+    self._pool.submit(self._notify_video, video, done)
 
-  def notify_video(self, video):
+  def _notify_video(self, video, done):
+    uploaded = False
     try:
+      self.ready.wait()
+      start = time.monotonic()
       link = self.upload_video(video)
-      self.send_message(link)
+      uploaded = True
+      upload_seconds.observe(time.monotonic() - start)
+      logging.info("uploaded '{0}' in {1:.1f}s".format(video, time.monotonic() - start))
+      if link:
+        self.send_message(link)
     except Exception as e:
+      upload_failures.inc()
       logging.error('While uploading video: %s' % e)
       traceback.print_exc()
+    finally:
+      self._slots.release()
+      if done:
+        done(video, uploaded)
 
   def upload_video(self, path):
-    if self.gdrive:
-      # Find folders
-      results = self.gdrive.files().list(pageSize=100, fields="files(id, name)",
-                                         q="mimeType = 'application/vnd.google-apps.folder' AND trashed != true").execute()
-      files = results.get('files', [])
-      # Find PiCamera folder
-      try:
-        folder = next(x for x in files if x['name'] == os.getenv('PYCAM_UPLOAD_DIR'))
-      except StopIteration:
-        # Create PiCamera folder if not exists
-        body = {'name': os.getenv('PYCAM_UPLOAD_DIR'),
-                'mimeType': 'application/vnd.google-apps.folder'}
-        folder = self.gdrive.files().create(body=body, fields='id, name').execute()
-
-      # Upload file
-      media = MediaFileUpload(path, mimetype='video/mp4')
-      body = {'name': os.path.basename(path), 'parents': [folder.get('id')]}
-      uploaded = self.gdrive.files().create(
-          body=body, fields='id, name, webViewLink, webContentLink', media_body=media).execute()
-
-      return uploaded.get('webViewLink')
-
-    elif self.dbx:
-      folder = '/%s/%s' % (os.getenv('PYCAM_UPLOAD_DIR'), datetime.date.today())
-      try:
-        self.dbx.files_get_metadata(folder)
-      except:
-        self.dbx.files_create_folder_v2(folder)
-
-      with open(path, 'rb') as f:
-        self.dbx.files_upload(f.read(), "%s/%s" % (folder, os.path.basename(path)))
+    """Upload to the preferred configured backend, returning a link to send."""
+    for backend in self.backends:
+      if backend.uploads:
+        return backend.upload_video(path)
 
   def send_message(self, link):
-    if self.tbot:
-      self.tbot.send_message(os.getenv('PYCAM_TELEGRAM_CHAT_ID'),
-                             'View Video: ' + link)
+    for backend in self.backends:
+      if backend.messages:
+        backend.send_message(link)
 
   def send_image(self, image):
-    if self.tbot:
-      self.tbot.send_photo(os.getenv('PYCAM_TELEGRAM_CHAT_ID'),
-                           photo=open(image, 'rb'), caption='Motion detected')
+    for backend in self.backends:
+      if backend.messages:
+        backend.send_image(image)
@@ -0,0 +1,141 @@
+import os
+import logging
+import threading
+import collections
+import mkv_muxer
+import metrics
+
+spilled_total = metrics.counter('pycam_preroll_spilled_bytes_total', 'Bytes of pre-roll spilled to disk')
+linked_total = metrics.counter('pycam_preroll_linked_bytes_total', 'Bytes of pre-roll linked into recordings')
+preroll_seconds = metrics.gauge('pycam_preroll_seconds', 'Seconds of pre-roll on disk')
+
+# A segment is one GOP, pre-muxed into Matroska SimpleBlocks, in the ring file
+Segment = collections.namedtuple('Segment', ['offset', 'size', 'first', 'last', 'index', 'sps', 'pps'])
+
+
+class PrerollStore(object):
+  """Long pre-roll at a small, fixed memory footprint: the camera's circular
+  buffer in RAM only needs to hold a few GOPs, older ones are spilled to a ring
+  file on disk, each GOP as a segment that is already muxed. When motion
+  triggers, the segments are linked into the recording with a kernel side copy
+  (MatroskaWriter.link), and the rest follows from the circular buffer.
+  """
+
+  def __init__(self, path, max_bytes):
+    """Initialize pre-roll store
+
+    Parameters
+    ----------
+    path : ring file, created with max_bytes
+    max_bytes : size of the ring, at least the bitrate times the pre-roll
+    """
+    self.path = path
+    self.max_bytes = max_bytes
+    self._segments = collections.deque()
+    self._end = 0  # where the next segment goes
+    self._lock = threading.Lock()
+    self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    os.ftruncate(self._fd, max_bytes)
+
+  def __len__(self):
+    return len(self._segments)
+
+  @property
+  def index(self):
+    """Camera frame index of the last frame spilled, or None."""
+    with self._lock:
+      return self._segments[-1].index if self._segments else None
+
+  def seconds(self):
+    with self._lock:
+      if not self._segments:
+        return 0.0
+      return (self._segments[-1].last - self._segments[0].first) / 1e6
+
+  def add(self, frames, index):
+    """Spill a GOP, as (Annex B data, timestamp in us) pairs starting with its
+    parameter sets, whose last frame has camera frame index index. Segments
+    that don't fit are dropped, and with them everything before."""
+    blocks, first, last, sps, pps = mkv_muxer.mux_blocks(frames)
+    if first is None or sps is None or pps is None or last - first > 30000000 or \
+        len(blocks) > self.max_bytes:
+      # no picture or parameter sets, or too long for the relative block times
+      self.clear()
+      return False
+    with self._lock:
+      offset = self._end if self._end + len(blocks) <= self.max_bytes else 0
+      # drop the segments about to be overwritten
+      while self._segments and self._segments[0].offset < offset + len(blocks) and \
+          self._segments[0].offset + self._segments[0].size > offset:
+        self._segments.popleft()
+    os.pwrite(self._fd, blocks, offset)
+    with self._lock:
+      self._segments.append(Segment(offset, len(blocks), first, last, index, sps, pps))
+      self._end = offset + len(blocks)
+    spilled_total.inc(len(blocks))
+    preroll_seconds.set(self.seconds())
+    return True
+
+  def segments(self, since):
+    """Segments of the GOPs which have a picture at or after timestamp since."""
+    with self._lock:
+      return [segment for segment in self._segments if segment.last >= since]
+
+  def link(self, output, segments):
+    """Link segments into a MatroskaWriter. Returns the number of bytes
+    written. The segments must not be overwritten meanwhile, i.e. nothing
+    should be spilled until this returns."""
+    written = 0
+    for segment in segments:
+      written += output.link(self._fd, segment.offset, segment.size, segment.first, segment.last,
+                             segment.sps, segment.pps)
+    linked_total.inc(written)
+    return written
+
+  def clear(self):
+    """Forget all segments, e.g. once they have been recorded."""
+    with self._lock:
+      self._segments.clear()
+    preroll_seconds.set(0)
+
+  def close(self):
+    os.close(self._fd)
+
+
+def read_frames(stream, frames):
+  """Read the data of consecutive frames from a picamera circular stream while
+  its lock is held, leaving its position where the camera writes."""
+  position = stream.tell()
+  try:
+    stream.seek(frames[0].position)
+    data = stream.read(frames[-1].position + frames[-1].frame_size - frames[0].position)
+  finally:
+    stream.seek(position)
+  start = frames[0].position
+  return [(data[frame.position - start:frame.position - start + frame.frame_size], frame.timestamp)
+          for frame in frames]
+
+
+def spill(stream, store, sps_header):
+  """Move the complete GOPs in a circular stream that are not spilled yet to
+  the store. Returns the number of GOPs spilled."""
+  last = store.index
+  with stream.lock:
+    frames = list(stream.frames)  # picamera's frames can only be iterated
+    if last is not None and frames and frames[0].index > last + 1:
+      # frames left the circular buffer before they were spilled
+      logging.warning("pre-roll fell behind the circular buffer, starting over")
+      store.clear()
+      last = None
+    frames = [frame for frame in frames if last is None or frame.index > last]
+    starts = [i for i, frame in enumerate(frames) if frame.frame_type == sps_header]
+    if len(starts) < 2:
+      return 0
+    data = read_frames(stream, frames[starts[0]:starts[-1]])
+  # write to disk without holding up the camera
+  spilled = 0
+  for begin, end in zip(starts, starts[1:]):
+    gop = data[begin - starts[0]:end - starts[0]]
+    if store.add(gop, frames[end - 1].index):
+      spilled += 1
+  return spilled
@@ -1,5 +1,8 @@
 #!/usr/bin/python3
 
+import time
+started = time.perf_counter()  # cold start timing, see below
+
 import os
 from dotenv import load_dotenv
 current_dir = os.path.dirname(os.path.realpath(__file__))
@@ -9,39 +12,61 @@ import logging
 import threading
 from motion_recorder import MotionRecorder
 from notification import Notification
+from metrics import MetricsServer
+imported = time.perf_counter()
 
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)-8s %(message)s')
 
-notification = Notification()
+metrics_port = int(os.getenv('PYCAM_METRICS_PORT', 0))
+if metrics_port:
+  MetricsServer(metrics_port).start()
+
 
+def watch_captures(captures, notification, events=None):
+  def uploaded(video, success):
+    if events:
+      events.uploaded(video, success)
+    # keep the video spooled for another attempt if the upload failed
+    if success:
+      captures.done(video)
+    else:
+      captures.failed(video)
 
-def watch_captures(captures):
   while True:
     video = captures.get()
     logging.info("motion capture in '{0}'".format(video))
-    notification.notify_video(video)
-    os.remove(video)
-    captures.task_done()
+    # uploads run in the background, this blocks only while all workers are busy
+    notification.notify_video(video, done=uploaded)
 
 
-def watch_images(images):
+def watch_images(images, notification):
   while True:
     image = images.get()
     logging.info("image capture in '{0}'".format(image))
-    notification.notify_image(image)
-    os.remove(image)
-    images.task_done()
+    if notification.notify_image(image):
+      images.done(image)
+    else:
+      images.failed(image)
 
 
 try:
-  with MotionRecorder() as mr:
+  recorder = MotionRecorder()  # recovers the spools and opens the event store
+  initialized = time.perf_counter()
+  with recorder as mr:
     mr.start()
+    ready = time.perf_counter()
+    logging.info("started in {0:.1f}s: imports {1:.1f}s, spools {2:.1f}s, camera {3:.1f}s".format(
+        ready - started, imported - started, initialized - imported, ready - initialized))
+    # upload and messaging backends are slow to set up, and not needed to
+    # detect and record motion, so they come last and in the background
+    notification = Notification(background=True)
     captures = threading.Thread(
-        name="watch_captures", target=watch_captures, daemon=True, args=[mr.captures])
+        name="watch_captures", target=watch_captures, daemon=True,
+        args=[mr.captures, notification, mr.events])
     images = threading.Thread(name="watch_images",
-                              target=watch_images, daemon=True, args=[mr.images])
+                              target=watch_images, daemon=True, args=[mr.images, notification])
     captures.start()
     images.start()
     captures.join()
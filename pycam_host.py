@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+"""Detect motion in many H.264 streams (network cameras, files) on one machine.
+Every stream is decoded and analysed in a worker process of its own, with its
+own MotionVectorReader, and records motion into Matroska files which all go
+through one shared spool and upload stage in the main process.
+
+  python3 pycam_host.py garden=rtsp://192.168.1.10/stream door=rtsp://192.168.1.11/stream
+  python3 pycam_host.py --no-upload --realtime test=clip.h264
+"""
+
+import os
+import time
+import queue
+import signal
+import argparse
+import logging
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+from dotenv import load_dotenv
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+load_dotenv(dotenv_path=os.path.join(current_dir, '.env'))
+
+from upload_spool import Spool
+
+# motion detection settings, as for the Pi camera
+area = int(os.getenv('PYCAM_DETECT_BLOCKS', 25))
+frames = int(os.getenv('PYCAM_DETECT_FRAMES', 4))
+prebuffer = int(os.getenv('PYCAM_PREBUFFER_SEC', 5))
+postbuffer = int(os.getenv('PYCAM_POSTBUFFER_SEC', 5))
+spool_size = int(os.getenv('PYCAM_SPOOL_MB', 1024)) * 1024 * 1024
+video_dir = os.path.join(current_dir, 'videos')
+video_file_pattern = '%Y-%m-%d_%H-%M-%S'
+
+StreamStats = collections.namedtuple('StreamStats', ['name', 'frames', 'seconds', 'events'])
+
+_recordings = None  # queue of finished recordings, shared by all workers
+
+
+def _init_worker(recordings):
+  global _recordings
+  _recordings = recordings
+  signal.signal(signal.SIGINT, signal.SIG_IGN)  # the main process shuts workers down
+
+
+def create_recording(directory, name):
+  """Create a new recording file of a stream, named after the current time.
+  Files replay faster than real time, so there can be several recordings in a
+  second: these are numbered rather than overwriting each other. Returns the
+  path and the file."""
+  base = os.path.join(directory, '{0}_{1}'.format(name, time.strftime(video_file_pattern)))
+  path = base + '.mkv'
+  number = 0
+  while True:
+    try:
+      return path, open(path, 'xb')
+    except FileExistsError:
+      number += 1
+      path = '{0}-{1}.mkv'.format(base, number)
+
+
+def watch_stream(name, source, directory, threads=1, realtime=False):
+  """Worker process: decode the motion vectors of one stream, detect motion in
+  them and record it. The last prebuffer seconds of packets are kept in memory,
+  starting at a keyframe, so that a recording can start before the motion did.
+  Paths of finished recordings are put on the shared recordings queue.
+  Returns StreamStats once the stream ends."""
+  # imported here so that the main process doesn't need PyAV
+  from motion_vector_decoder import read_stream
+  from motion_vector_reader import MotionVectorReader
+  from motion_replay import ReplayCamera, Frame
+  from recording_writer import RecordingWriter
+  from mkv_muxer import MatroskaWriter
+  import av
+
+  with av.open(source) as container:
+    stream = container.streams.video[0]
+    framerate = int(stream.guessed_rate or 10)
+    width, height = stream.codec_context.width, stream.codec_context.height
+  camera = ReplayCamera((width, height), framerate)
+  motion = MotionVectorReader(camera, window=postbuffer * framerate, area=area, frames=frames,
+                              framerate=framerate)
+  motion.clear()
+  writer = RecordingWriter()
+  writer.start()
+
+  gops = collections.deque()  # packets of the pre-buffer, one list per GOP
+  output = path = None
+  batch = []  # packets waiting to be written to the recording
+  events = count = 0
+  start = time.perf_counter()
+  for data, keyframe, timestamp, decoded in read_stream(source, threads=threads):
+    if data:
+      packet = (data, timestamp)
+      if keyframe:
+        gops.append([])
+        # drop the oldest GOP while the newer ones cover the pre-buffer
+        while len(gops) > 2 and sum(len(gop) for gop in gops) - len(gops[0]) >= prebuffer * framerate:
+          gops.popleft()
+      if gops:
+        gops[-1].append(packet)
+      if output:
+        batch.append(packet)
+    for index, frame_time, a in decoded:
+      if realtime:
+        time.sleep(max(start + index / framerate - time.perf_counter(), 0))
+      camera.frame = Frame(index, frame_time or int(index * 1000000 / framerate))
+      motion.analyse(a)
+      count += 1
+    if motion.motion() and output is None:
+      events += 1
+      path, f = create_recording(directory, name)
+      output = MatroskaWriter(f, width, height, framerate)
+      batch = [packet for gop in gops for packet in gop]
+    if output and len(batch) >= framerate:
+      writer.submit(output.write, batch)
+      batch = []
+    if output and not motion.motion():
+      writer.submit(output.write, batch)
+      writer.submit(output.close)
+      writer.flush()
+      _recordings.put(path)
+      output = None
+      gops.clear()  # the next recording starts at the next keyframe
+  if output:
+    writer.submit(output.write, batch)
+    writer.submit(output.close)
+    writer.flush()
+    _recordings.put(path)
+  return StreamStats(name, count, time.perf_counter() - start, events)
+
+
+def upload(spool, notification):
+  """Shared upload stage: uploads recordings from all streams."""
+  def uploaded(video, success):
+    if success:
+      spool.done(video)
+    else:
+      spool.failed(video)
+
+  while True:
+    video = spool.get()
+    logging.info("motion capture in '{0}'".format(video))
+    if notification:
+      notification.notify_video(video, done=uploaded)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('streams', nargs='+', metavar='name=source',
+                      help="stream name and file or URL that libavformat can open")
+  parser.add_argument('--workers', type=int,
+                      help="worker processes, by default and at least one per stream")
+  parser.add_argument('--threads', type=int,
+                      help="decoder threads per stream, by default cores / streams")
+  parser.add_argument('--realtime', action='store_true',
+                      help="pace files at their frame rate instead of as fast as possible")
+  parser.add_argument('--restart', type=float, default=10.0,
+                      help="seconds before watching a stream again after it ended or failed, "
+                      "negative to stop")
+  parser.add_argument('--no-upload', action='store_true', help="keep recordings in the spool")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+
+  streams = dict(stream.split('=', 1) for stream in args.streams)
+  if args.workers is not None and args.workers < len(streams):
+    # a worker watches a live stream for as long as it runs, so streams beyond
+    # the workers would wait forever without being watched
+    parser.error("--workers {0} is fewer than the {1} streams".format(args.workers, len(streams)))
+  workers = args.workers or len(streams)
+  threads = args.threads or max(os.cpu_count() // len(streams), 1)
+  spool = Spool(video_dir, spool_size)
+  notification = None
+  if not args.no_upload:
+    from notification import Notification
+    notification = Notification()
+  threading.Thread(name="upload", target=upload, args=(spool, notification), daemon=True).start()
+
+  recordings = multiprocessing.Queue()
+  pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                initargs=(recordings,))
+  futures = {pool.submit(watch_stream, name, source, video_dir, threads, args.realtime): name
+             for name, source in streams.items()}
+  restarts = []  # (time, name) of streams to watch again
+  try:
+    while futures or restarts:
+      try:
+        spool.put(recordings.get(timeout=1))
+        continue
+      except queue.Empty:
+        pass
+      for future in [future for future in futures if future.done()]:
+        name = futures.pop(future)
+        try:
+          stats = future.result()
+          logging.info("stream '{0}' ended: {1} frames in {2:.1f}s ({3:.0f} fps), {4} events".format(
+              name, stats.frames, stats.seconds, stats.frames / stats.seconds if stats.seconds else 0,
+              stats.events))
+        except Exception as e:
+          logging.error("while watching stream '{0}': {1}".format(name, e))
+        if args.restart >= 0:
+          restarts.append((time.monotonic() + args.restart, name))
+      for due, name in [restart for restart in restarts if restart[0] <= time.monotonic()]:
+        restarts.remove((due, name))
+        futures[pool.submit(watch_stream, name, streams[name], video_dir, threads,
+                            args.realtime)] = name
+    # pick up the last recordings
+    while True:
+      spool.put(recordings.get(timeout=1))
+  except queue.Empty:
+    pass
+  except KeyboardInterrupt:
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in list(getattr(pool, '_processes', {}).values()):
+      process.terminate()
+
+
+if __name__ == '__main__':
+  main()
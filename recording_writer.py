@@ -0,0 +1,66 @@
+import time
+import queue
+import logging
+import threading
+import metrics
+
+write_seconds = metrics.histogram('pycam_write_seconds', 'Time to mux and write a buffer snapshot to disk')
+written_total = metrics.counter('pycam_written_bytes_total', 'Bytes of recordings written to disk')
+
+
+class RecordingWriter(threading.Thread):
+  """Background thread for writing recordings to disk. The recorder snapshots
+  the circular buffer into memory and hands it over, so that slow storage only
+  ever delays this thread, never the encoder writing into the circular buffer.
+  """
+
+  bytes_written = 0  # total bytes written
+  write_time = 0.0  # total seconds spent writing
+
+  def __init__(self, depth=4):
+    """Initialize recording writer
+
+    Parameters
+    ----------
+    depth : number of pending writes before submit() blocks, bounding the memory
+            held by buffer snapshots
+    """
+    super().__init__(name="recording writer", daemon=True)
+    self._queue = queue.Queue(maxsize=depth)
+    metrics.gauge('pycam_write_queue', 'Buffer snapshots waiting to be written', self.pending)
+
+  def __str__(self):
+    return "{0:.1f} MB written at {1:.2f} MB/s".format(self.bytes_written / 1e6, self.throughput() / 1e6)
+
+  def throughput(self):
+    """Average write throughput in bytes per second."""
+    return self.bytes_written / self.write_time if self.write_time else 0.0
+
+  def pending(self):
+    return self._queue.qsize()
+
+  def submit(self, func, *args):
+    """Queue func(*args) for the writer thread. Calls run in order. func may
+    return the number of bytes written, as file.write() does."""
+    self._queue.put((func, args))
+
+  def flush(self):
+    """Wait until all submitted writes are done."""
+    self._queue.join()
+
+  def run(self):
+    while True:
+      func, args = self._queue.get()
+      try:
+        start = time.perf_counter()
+        written = func(*args)
+        elapsed = time.perf_counter() - start
+        self.write_time += elapsed
+        write_seconds.observe(elapsed)
+        if written:
+          self.bytes_written += written
+          written_total.inc(written)
+      except Exception as e:
+        logging.error("while writing recording: %s" % e)
+      finally:
+        self._queue.task_done()
@@ -0,0 +1,312 @@
+import io
+import os
+import time
+import types
+import logging
+import threading
+import collections
+import motion_replay
+from mkv_muxer import nal_units, NAL_SLICE, NAL_IDR
+
+# A simulated camera backend for MotionRecorder, implementing the subset of the
+# picamerax API that pycam uses, so the whole recording pipeline can run on any
+# Linux box. It plays back an H.264 file (PYCAM_SIM_VIDEO) and a motion vector
+# archive, synthetic scenario or the video's own MVs (PYCAM_SIM_MOTION), both
+# looped, at PYCAM_SIM_SPEED times real time. Without a video file, frames are filler NAL units at the
+# configured bitrate: recordings then exercise the pipeline but don't decode.
+
+
+class PiVideoFrameType(object):
+  frame = 0
+  key_frame = 1
+  sps_header = 2
+  motion_data = 3
+
+
+PiVideoFrame = collections.namedtuple('PiVideoFrame', [
+    'index', 'frame_type', 'frame_size', 'video_size', 'split_size', 'timestamp',
+    'complete', 'position'])
+
+
+class PiCameraError(Exception):
+  pass
+
+
+class PiCameraNotRecording(PiCameraError):
+  pass
+
+
+class PiCameraRuntimeError(PiCameraError):
+  pass
+
+
+exc = types.SimpleNamespace(PiCameraError=PiCameraError, PiCameraNotRecording=PiCameraNotRecording,
+                            PiCameraRuntimeError=PiCameraRuntimeError)
+
+
+def h264_frames(file):
+  """Generator over the frames of an H.264 Annex B file, yielding (data, frame
+  type) like the camera does: parameter sets as a header frame of their own,
+  then every picture with all its slices."""
+  with open(file, 'rb') as f:
+    units = nal_units(f.read())
+  if not any(NAL_SLICE <= unit[0] & 0x1f <= NAL_IDR for unit in units):
+    raise ValueError("{0}: no H.264 pictures found".format(file))
+  header, picture = [], []
+  for unit in units + [None]:
+    kind = unit[0] & 0x1f if unit else None
+    # a slice with first_mb_in_slice 0 (its first bit set) starts a new picture
+    if picture and (unit is None or not NAL_SLICE <= kind <= NAL_IDR or unit[1] & 0x80):
+      keyframe = any(u[0] & 0x1f == NAL_IDR for u in picture)
+      yield b''.join(b'\x00\x00\x00\x01' + u for u in picture), \
+          PiVideoFrameType.key_frame if keyframe else PiVideoFrameType.frame
+      picture = []
+    if unit is None:
+      break
+    if NAL_SLICE <= kind <= NAL_IDR:
+      if header:
+        yield b''.join(b'\x00\x00\x00\x01' + u for u in header), PiVideoFrameType.sps_header
+        header = []
+      picture.append(unit)
+    else:
+      header.append(unit)
+
+
+def filler_frames(bitrate, framerate, intra_period):
+  """Endless generator of stand-in H.264 frames of about the size the encoder
+  would produce, with parameter sets and an IDR picture every intra_period."""
+  size = max(bitrate // 8 // framerate, 16)
+  sps = b'\x00\x00\x00\x01\x67\x64\x00\x29\xac\x2b\x40'
+  pps = b'\x00\x00\x00\x01\x68\xee\x3c\x80'
+  index = 0
+  while True:
+    if index % max(intra_period, 1) == 0:
+      yield sps + pps, PiVideoFrameType.sps_header
+      yield b'\x00\x00\x00\x01\x65\x88' + b'\xa5' * (4 * size), PiVideoFrameType.key_frame
+    else:
+      yield b'\x00\x00\x00\x01\x41\x9a' + b'\xa5' * size, PiVideoFrameType.frame
+    index += 1
+
+
+def motion_vector_frames(source, resolution, video=None):
+  """Endless generator of MV arrays from an archive or dump, a synthetic scenario, or
+  decoded from the video file if source is 'video'."""
+  while True:
+    if source == 'video':
+      from motion_vector_decoder import decode_motion_vectors
+      frames = (a for _, _, a in decode_motion_vectors(video))
+    elif os.path.exists(source):
+      frames = (a for _, a in motion_replay.read_frames(source))
+    else:
+      frames = motion_replay.synthetic_motion_vectors(
+          *resolution, frames=1 << 62, **motion_replay.scenarios[source])
+    empty = True
+    for a in frames:
+      empty = False
+      yield a
+    if empty:
+      raise ValueError("{0}: no motion vectors found".format(source))
+
+
+class PiCameraDequeFrames(object):
+  """View of the frames in a circular stream, which picamera only lets you
+  iterate, forwards or backwards."""
+
+  def __init__(self, stream):
+    self._stream = stream
+
+  def __iter__(self):
+    with self._stream.lock:
+      return iter([frame for frame, _ in self._stream._frames])
+
+  def __reversed__(self):
+    with self._stream.lock:
+      return iter([frame for frame, _ in reversed(self._stream._frames)])
+
+
+class PiCameraCircularIO(object):
+  """In-memory ring of the most recent frames, like picamera's circular stream:
+  frames are kept whole, and the oldest are dropped beyond bitrate * seconds."""
+
+  def __init__(self, camera, size=None, seconds=None, bitrate=17000000, splitter_port=1):
+    self.camera = camera
+    self.size = size if size is not None else bitrate * seconds // 8
+    self.lock = threading.RLock()
+    self._frames = collections.deque()  # (frame, data)
+    self._bytes = 0
+    self._position = 0  # where the next frame goes
+    self._cursor = None  # read position, if seek()ed
+
+  @property
+  def frames(self):
+    # like picamera's PiCameraDequeFrames: iterable, but not a sequence
+    return PiCameraDequeFrames(self)
+
+  def tell(self):
+    return self._position if self._cursor is None else self._cursor
+
+  def seek(self, offset):
+    with self.lock:
+      self._cursor = None if offset == self._position else offset
+
+  def read(self, size=-1):
+    """Read from frames still in the ring, from the position seek()ed to."""
+    with self.lock:
+      start = self.tell()
+      end = self._position if size < 0 else min(start + size, self._position)
+      data = b''.join(data[max(start - frame.position, 0):end - frame.position]
+                      for frame, data in self._frames
+                      if frame.position < end and frame.position + len(data) > start)
+      self._cursor = end
+      return data
+
+  def _append(self, index, data, frame_type, timestamp):
+    frame = PiVideoFrame(index, frame_type, len(data), self._position + len(data), 0,
+                         timestamp, True, self._position)
+    with self.lock:
+      self._frames.append((frame, data))
+      self._position += len(data)
+      self._bytes += len(data)
+      while self._bytes > self.size and len(self._frames) > 1:
+        self._bytes -= len(self._frames.popleft()[1])
+    return frame
+
+  def clear(self):
+    with self.lock:
+      self._frames.clear()
+      self._bytes = 0
+      self._cursor = None
+
+  def copy_to(self, output, size=None, seconds=None, frames=None,
+              first_frame=PiVideoFrameType.sps_header):
+    """Write the recent frames to output, starting from the first frame of type
+    first_frame if given. Returns the first and last frame written."""
+    with self.lock:
+      entries = list(self._frames)
+    if seconds is not None:
+      timestamps = [frame.timestamp for frame, _ in entries if frame.timestamp is not None]
+      if timestamps:
+        cutoff = timestamps[-1] - seconds * 1000000
+        start = len(entries)
+        while start and (entries[start - 1][0].timestamp is None or
+                         entries[start - 1][0].timestamp >= cutoff):
+          start -= 1
+        entries = entries[start:]
+    if frames is not None:
+      entries = entries[-frames:]
+    if first_frame is not None:
+      while entries and entries[0][0].frame_type != first_frame:
+        entries.pop(0)
+    if not entries:
+      return None, None
+    for _, data in entries:
+      output.write(data)
+    return entries[0][0], entries[-1][0]
+
+
+class _Overlay(object):
+
+  def update(self, source):
+    pass
+
+
+class PiCamera(object):
+  """Camera playing back recorded or synthetic video and motion vectors."""
+
+  video = os.getenv('PYCAM_SIM_VIDEO', '')  # H.264 Annex B file, or filler frames
+  # MV archive or dump, synthetic scenario, or 'video' to decode MVs from the video file
+  motion = os.getenv('PYCAM_SIM_MOTION', 'walker')
+  speed = float(os.getenv('PYCAM_SIM_SPEED', 1))  # multiple of real time
+
+  led = False
+  rotation = 0
+  exposure_mode = 'auto'
+  exposure_speed = 10000
+  analog_gain = 1.0
+  digital_gain = 1.0
+  annotate_text = ''
+  annotate_background = False
+
+  def __init__(self, resolution=(1640, 1232), framerate=10, framerate_range=None, **kwargs):
+    self.resolution = resolution
+    self.framerate = framerate_range[1] if framerate_range else framerate
+    self.frame = PiVideoFrame(0, PiVideoFrameType.frame, 0, 0, 0, 0, True, 0)
+    self._stopped = threading.Event()
+    self._stopped.set()
+    self._thread = None
+    self._jpeg = None
+
+  @property
+  def recording(self):
+    return not self._stopped.is_set()
+
+  def start_recording(self, output, format=None, motion_output=None, bitrate=17000000,
+                      intra_period=None, **kwargs):
+    if self.video:
+      video = h264_frames(self.video)
+      next(video)  # fail early on an unusable file
+      video = self._loop(lambda: h264_frames(self.video))
+    else:
+      video = filler_frames(bitrate, self.framerate, intra_period or self.framerate)
+    self._stopped.clear()
+    self._thread = threading.Thread(name="simulated camera", target=self._record, args=(
+        output, motion_output, video), daemon=True)
+    self._thread.start()
+
+  @staticmethod
+  def _loop(frames):
+    while True:
+      yield from frames()
+
+  def _record(self, output, motion_output, video):
+    """Feed frames to the circular buffer and motion vectors to the motion
+    output, paced at speed times the frame rate."""
+    vectors = motion_vector_frames(self.motion, self.resolution, self.video) if motion_output else None
+    begin = time.perf_counter()
+    index = 0
+    try:
+      for data, frame_type in video:
+        if frame_type == PiVideoFrameType.sps_header:
+          output._append(index, data, frame_type, None)
+          continue
+        timestamp = int(index * 1000000 / self.framerate)
+        if self._stopped.wait(max(begin + timestamp / 1000000 / self.speed - time.perf_counter(), 0)):
+          return
+        self.frame = output._append(index, data, frame_type, timestamp)
+        if vectors:
+          motion_output.analyse(next(vectors))
+        index += 1
+    except Exception as e:
+      logging.error("simulated camera stopped: %s" % e)
+      self._stopped.set()
+
+  def wait_recording(self, timeout=0.0, splitter_port=1):
+    if not self.recording:
+      raise PiCameraNotRecording("there is no recording in progress")
+    self._stopped.wait(timeout / self.speed)
+
+  def stop_recording(self, splitter_port=1):
+    self._stopped.set()
+    if self._thread and self._thread is not threading.current_thread():
+      self._thread.join()
+
+  def capture(self, output, format='jpeg', use_video_port=False, quality=85, **kwargs):
+    """Capture a blank JPEG image of the camera's resolution."""
+    if self._jpeg is None:
+      from PIL import Image
+      jpeg = io.BytesIO()
+      Image.new('RGB', self.resolution, (128, 128, 128)).save(jpeg, 'jpeg', quality=quality)
+      self._jpeg = jpeg.getvalue()
+    output.write(self._jpeg)
+
+  def start_preview(self, **kwargs):
+    pass
+
+  def add_overlay(self, source, size=None, **kwargs):
+    return _Overlay()
+
+  def remove_overlay(self, overlay):
+    pass
+
+  def close(self):
+    self.stop_recording()
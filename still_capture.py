@@ -0,0 +1,79 @@
+import io
+import os
+import time
+import logging
+import threading
+
+
+class StillCapture(threading.Thread):
+  """Background thread for taking a still image when motion is detected. The
+  JPEG is captured from the video port into a reusable in-memory buffer at its
+  final quality, and written to disk once. Rather than the first frame, it can
+  pick the frame with the largest area of motion among the first few frames.
+  """
+
+  def __init__(self, camera, motion, directory, spool, quality=75, frames=0,
+               file_pattern='%Y-%m-%d_%H-%M-%S'):
+    """Initialize still capture
+
+    Parameters
+    ----------
+    camera : PiCamera
+    motion : MotionVectorReader analysing the camera's motion vectors
+    directory : where images are saved
+    spool : images are put() here once saved
+    quality : JPEG quality
+    frames : number of frames after motion is detected to pick the best one from,
+             or 0 to capture right away
+    """
+    super().__init__(name="still capture", daemon=True)
+    self.camera = camera
+    self.motion = motion
+    self.directory = directory
+    self.spool = spool
+    self.quality = quality
+    self.frames = frames
+    self.file_pattern = file_pattern
+    self._triggered = threading.Event()
+    self._name = None
+    # the best capture so far, and the buffer for the next one
+    self._best = io.BytesIO()
+    self._next = io.BytesIO()
+
+  def trigger(self):
+    """Take a still image of the motion that was just detected. Returns right away."""
+    if not self._triggered.is_set():
+      self._name = time.strftime(self.file_pattern)
+      self._triggered.set()
+
+  def _capture(self, buffer):
+    buffer.seek(0)
+    buffer.truncate()
+    self.camera.capture(buffer, use_video_port=True, format='jpeg', quality=self.quality)
+
+  def run(self):
+    while True:
+      self._triggered.wait()
+      try:
+        self._capture(self._best)
+        # while the first frames of motion go by, capture again whenever the
+        # largest area of motion is bigger than in the best capture so far
+        largest = self.motion.largest
+        first = last = self.motion.index
+        while self.camera.recording and last is not None and last - first < self.frames:
+          self.camera.wait_recording(self.motion.budget)
+          if self.motion.index == last:
+            continue
+          last = self.motion.index
+          if self.motion.largest > largest:
+            largest = self.motion.largest
+            self._capture(self._next)
+            self._best, self._next = self._next, self._best
+        path = os.path.join(self.directory, self._name + '.jpg')
+        with open(path, 'wb') as f:
+          f.write(self._best.getbuffer())
+        self.spool.put(path)
+      except Exception as e:
+        logging.error("while capturing still image: %s" % e)
+      finally:
+        self._triggered.clear()
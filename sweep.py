@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+"""Tune motion detection offline: evaluate every combination of area, frames
+and window settings over a corpus of motion vector archives (see
+MotionVectorReader.save_motion_vectors) or H.264 recordings, and report how
+often each would have triggered. Files are analysed in parallel, once per noise
+decay rate, with motion_batch, so that trying many settings costs hardly more
+than trying one.
+
+  python3 sweep.py --area 10,25,40 --frames 2,4,8 --window 50,100 motion_vectors/*.mva
+  python3 sweep.py --area 25 --frames 4 --window 75 --timeline motion_vectors/
+"""
+
+import os
+import time
+import argparse
+import itertools
+import concurrent.futures
+import numpy as np
+import motion_batch
+import motion_replay
+import motion_mask
+
+
+def evaluate(file, windows, settings, chunk=1000, mask=None):
+  """Process pool task: analyse one file for windows sharing a noise decay
+  rate, then work out the trigger timeline of every (area, frames) setting for
+  each. Returns {(area, frames, window): (trigger intervals as frame indexes,
+  frames with the trigger set)} and the number of frames."""
+  indexes = []
+  source = motion_replay.read_frames(file)
+  first = next(source, None)
+  weights = None
+  if mask and first is not None:
+    weights = motion_mask.load_mask(mask, motion_replay.grid_resolution(first[1].shape))
+
+  def frames():
+    for index, a in itertools.chain([first] if first else [], source):
+      indexes.append(index)
+      yield a
+  largest = motion_batch.largest_areas(frames(), windows[0], chunk, weights)
+  indexes = np.array(indexes, dtype=np.int64)
+  results = {}
+  for window in windows:
+    for area, repeat in settings:
+      _, trigger = motion_batch.trigger_timeline(largest, area, repeat, window)
+      intervals = [(int(indexes[first]), int(indexes[last]))
+                   for first, last in motion_batch.trigger_intervals(trigger)]
+      results[(area, repeat, window)] = (intervals, int(np.count_nonzero(trigger)))
+  return file, results, len(largest)
+
+
+def integers(value):
+  return [int(v) for v in value.split(',')]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('files', nargs='+',
+                      help="motion vector archives or directories of them, legacy dumps or H.264 recordings")
+  parser.add_argument('--area', type=integers, default=[int(os.getenv('PYCAM_DETECT_BLOCKS', 25))],
+                      help="comma separated minimum areas of motion in MV blocks")
+  parser.add_argument('--frames', type=integers, default=[int(os.getenv('PYCAM_DETECT_FRAMES', 4))],
+                      help="comma separated numbers of frames with motion to trigger")
+  parser.add_argument('--window', type=integers,
+                      default=[int(os.getenv('PYCAM_POSTBUFFER_SEC', 5)) * int(os.getenv('PYCAM_FPS_MAX', 10))],
+                      help="comma separated window lengths in frames")
+  parser.add_argument('--mask', default=os.getenv('PYCAM_DETECT_MASK') or None,
+                      help="region of interest mask, an image or .npy file (see motion_mask)")
+  parser.add_argument('--workers', type=int, help="worker processes, by default one per core")
+  parser.add_argument('--timeline', action='store_true',
+                      help="list the frames during which every setting triggered")
+  args = parser.parse_args()
+
+  settings = list(itertools.product(args.area, args.frames))
+  windows = {}  # windows by noise decay rate, which share the analysis
+  for window in sorted(set(args.window)):
+    windows.setdefault(motion_batch.noise_shift(window), []).append(window)
+
+  start = time.perf_counter()
+  results = {}  # setting -> file -> (intervals, frames triggered)
+  counts = {}  # file -> frames
+  with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+    tasks = [pool.submit(evaluate, file, group, settings, mask=args.mask)
+             for file in args.files for group in windows.values()]
+    for task in concurrent.futures.as_completed(tasks):
+      file, evaluated, count = task.result()
+      counts[file] = count
+      for setting, result in evaluated.items():
+        results.setdefault(setting, {})[file] = result
+  elapsed = time.perf_counter() - start
+
+  total = sum(counts.values())
+  print("{0} settings over {1} frames in {2} files in {3:.1f}s".format(
+      len(results), total, len(counts), elapsed))
+  print("{0:>6} {1:>6} {2:>6} {3:>9} {4:>10}  {5}".format(
+      'area', 'frames', 'window', 'triggers', 'triggered', 'triggers per file'))
+  for setting in sorted(results):
+    per_file = [len(results[setting][file][0]) for file in args.files]
+    triggered = sum(results[setting][file][1] for file in args.files)
+    print("{0:>6} {1:>6} {2:>6} {3:>9} {4:>9.1f}%  {5}".format(
+        *setting, sum(per_file), 100 * triggered / total if total else 0.0,
+        ' '.join(map(str, per_file))))
+    if args.timeline:
+      for file in args.files:
+        intervals = results[setting][file][0]
+        if intervals:
+          print("    {0}: {1}".format(os.path.basename(file), ' '.join(
+              '{0}-{1}'.format(first, last) for first, last in intervals)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,23 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from event_store import EventStore, MotionSeries
+
+
+def test_series_flush_writes_last_second(tmp_path, monkeypatch):
+  monkeypatch.setattr(time, 'time', lambda: 1700000000.5)
+  store = EventStore(str(tmp_path / 'events.db'), interval=0.1)
+  store.start()
+  series = MotionSeries(store)
+  for _ in range(3):
+    series.add(10, 5, False)
+  series.add(40, 30, True)
+  series.flush()
+  store.close()
+  store = EventStore(str(tmp_path / 'events.db'))
+  rows = store.series(0)
+  store.close()
+  assert [row[1:] for row in rows] == [(4, 17.5, 30, 1)]
@@ -0,0 +1,36 @@
+import os
+import sys
+import warnings
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import motion_mask
+from motion_vector_reader import grid_shape
+
+
+def test_resample_averages_down():
+  a = np.arange(16, dtype=float).reshape(4, 4)
+  np.testing.assert_array_equal(motion_mask.resample(a, (2, 2)), [[2.5, 4.5], [10.5, 12.5]])
+
+
+def test_resample_repeats_up():
+  a = np.array([[0, 255], [255, 0]])
+  np.testing.assert_array_equal(motion_mask.resample(a, (4, 3)),
+                                [[0, 0, 255], [0, 0, 255], [255, 255, 0], [255, 255, 0]])
+
+
+def test_mask_smaller_than_grid(tmp_path):
+  # left half excluded, drawn at 8x6 for a grid of 45x81 blocks
+  a = np.ones((6, 8), dtype=bool)
+  a[:, :4] = False
+  path = str(tmp_path / 'mask.npy')
+  np.save(path, a)
+  with warnings.catch_warnings():
+    warnings.simplefilter('error')
+    weights = motion_mask.load_mask(path, (1280, 720))
+  rows, cols = grid_shape(1280, 720)
+  assert weights.shape == (rows, cols)
+  assert (weights[:, :(cols - 1) // 2] == 0).all()
+  assert (weights[:, (cols - 1) // 2:-1] == motion_mask.FULL).all()
+  assert (weights[:, -1] == 0).all()
@@ -0,0 +1,44 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import motion_batch
+import motion_replay
+from motion_vector_reader import MotionVectorReader
+
+
+def synthetic(scenario, frames):
+  return list(motion_replay.synthetic_motion_vectors(
+      1280, 720, frames=frames, **motion_replay.scenarios[scenario]))
+
+
+def reader():
+  return MotionVectorReader(motion_replay.ReplayCamera((1280, 720), 15), window=75, area=25,
+                            frames=4, framerate=15)
+
+
+def test_still_scene_does_not_trigger():
+  _, results, triggers, _ = motion_replay.replay(reader(), synthetic('still', 200))
+  assert triggers == []
+  assert not any(results)
+
+
+def test_batch_matches_reader():
+  frames = synthetic('walker', 600)
+  _, results, triggers, _ = motion_replay.replay(reader(), frames)
+  assert triggers
+  largest = motion_batch.largest_areas(frames, 75, chunk=100)
+  np.testing.assert_array_equal(largest >= 25, results)
+
+
+def test_still_scene_does_not_trigger_when_shedding_load():
+  motion = reader()
+  frames = synthetic('still', 400)
+  motion_replay.replay(motion, frames[:200])
+  for level in (2, 0, 3):
+    motion.level = level
+    _, results, triggers, _ = motion_replay.replay(motion, frames[200:300])
+    assert triggers == []
+    assert not any(results)
@@ -0,0 +1,58 @@
+import os
+import sys
+import queue
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+av = pytest.importorskip('av')
+import pycam_host
+
+
+def make_clip(path, events, framerate=10, still=90, moving=20):
+  """H.264 clip of a textured scene, still for longer than the post-buffer
+  and then crossed by a textured square, events times."""
+  rng = np.random.default_rng(1)
+  background = rng.integers(0, 256, (240, 320), dtype=np.uint8).repeat(2, 0).repeat(2, 1)
+  square = rng.integers(0, 256, (60, 60), dtype=np.uint8).repeat(2, 0).repeat(2, 1)
+  with av.open(str(path), 'w') as container:
+    stream = container.add_stream('libx264', rate=framerate)
+    stream.width, stream.height, stream.pix_fmt = 640, 480, 'yuv420p'
+    stream.options = {'g': str(framerate), 'bf': '0'}
+    for event in range(events):
+      for i in range(still + moving):
+        y = background.copy()
+        if i >= still:
+          x = 16 + (i - still) * 16
+          y[160:280, x:x + 120] = square
+        frame = av.VideoFrame.from_ndarray(np.stack([y, y, y], -1), format='rgb24')
+        for packet in stream.encode(frame):
+          container.mux(packet)
+    for packet in stream.encode():
+      container.mux(packet)
+
+
+def test_recording_per_event(tmp_path, monkeypatch):
+  # a file replays in about a second, so all events fall into the same one
+  clip = tmp_path / 'clip.mkv'
+  make_clip(clip, events=3)
+  videos = tmp_path / 'videos'
+  videos.mkdir()
+  recordings = queue.Queue()
+  monkeypatch.setattr(pycam_host, '_recordings', recordings)
+  stats = pycam_host.watch_stream('test', str(clip), str(videos))
+  assert stats.events == 3
+  assert len(os.listdir(videos)) == stats.events
+  assert recordings.qsize() == stats.events
+
+
+def test_create_recording_numbers_files(tmp_path, monkeypatch):
+  monkeypatch.setattr(pycam_host.time, 'strftime', lambda pattern: '2024-01-01_12-00-00')
+  paths = []
+  for _ in range(3):
+    path, f = pycam_host.create_recording(str(tmp_path), 'door')
+    f.close()
+    paths.append(os.path.basename(path))
+  assert paths == ['door_2024-01-01_12-00-00.mkv', 'door_2024-01-01_12-00-00-1.mkv',
+                   'door_2024-01-01_12-00-00-2.mkv']
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import logging
+import threading
+import collections
+import metrics
+
+PENDING = 'pending'
+INFLIGHT = 'inflight'
+DONE = 'done'
+
+evicted_total = metrics.counter('pycam_spool_evicted_total',
+                                'Spooled files evicted before upload to stay within the size cap')
+
+
+class Spool(object):
+  """Durable queue of files waiting for upload, kept in a spool directory. A
+  journal in the directory tracks which files are pending, in flight or done,
+  so that nothing is lost on restart, and files whose upload failed are retried
+  with backoff until it succeeds. Total disk use is capped by evicting the
+  oldest pending files.
+
+  It is used like a queue: get() a file, then report it done() or failed().
+  """
+
+  backoff = 30  # seconds before the first retry, doubling up to max_backoff
+  max_backoff = 3600
+
+  def __init__(self, directory, max_bytes=1 << 30, extensions=('.mkv', '.jpg')):
+    """Initialize spool
+
+    Parameters
+    ----------
+    directory : spool directory, holding the files and the journal
+    max_bytes : cap on the total size of spooled files
+    extensions : files with these extensions found in the directory but not in
+                 the journal (e.g. after a power cut) are spooled as well
+    """
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.evicted = 0  # number of files evicted to stay within max_bytes
+    self._journal_path = os.path.join(directory, '.journal')
+    self._ready = threading.Condition()
+    # path -> [state, size, failed attempts, time of next attempt], oldest first
+    self._files = collections.OrderedDict()
+    self._recover(extensions)
+
+  def __len__(self):
+    return len(self._files)
+
+  def qsize(self):
+    """Number of files waiting for upload, including those in flight."""
+    return len(self._files)
+
+  def size(self):
+    """Total size of spooled files in bytes."""
+    return sum(entry[1] for entry in self._files.values())
+
+  def _recover(self, extensions):
+    states = collections.OrderedDict()
+    try:
+      with open(self._journal_path, 'r') as f:
+        for line in f:
+          try:
+            path, state = json.loads(line)
+          except ValueError:
+            continue  # torn last line
+          states[path] = state
+    except FileNotFoundError:
+      pass
+    for name in sorted(os.listdir(self.directory)):
+      path = os.path.join(self.directory, name)
+      if os.path.splitext(name)[1] in extensions and path not in states:
+        states[path] = PENDING
+    for path, state in states.items():
+      if state != DONE and os.path.exists(path):
+        # uploads in flight at shutdown start over
+        self._files[path] = [PENDING, os.path.getsize(path), 0, 0.0]
+    self._compact()
+    if self._files:
+      logging.info("{0} files waiting for upload in '{1}'".format(len(self._files), self.directory))
+
+  def _compact(self):
+    tmp = self._journal_path + '.tmp'
+    with open(tmp, 'w') as f:
+      for path, entry in self._files.items():
+        f.write(json.dumps((path, entry[0])) + '\n')
+    os.replace(tmp, self._journal_path)
+    self._journal = open(self._journal_path, 'a')
+    self._records = len(self._files)
+
+  def _log(self, path, state):
+    self._journal.write(json.dumps((path, state)) + '\n')
+    self._journal.flush()
+    os.fsync(self._journal.fileno())
+    self._records += 1
+    if self._records > 4 * len(self._files) + 100:
+      self._journal.close()
+      self._compact()
+
+  def put(self, path):
+    """Spool a file, evicting the oldest pending files if over the size cap."""
+    with self._ready:
+      self._files[path] = [PENDING, os.path.getsize(path), 0, 0.0]
+      self._log(path, PENDING)
+      total = self.size()
+      for old, entry in list(self._files.items()):
+        if total <= self.max_bytes:
+          break
+        if entry[0] == PENDING and old != path:
+          logging.warning("spool '{0}' is full, evicting '{1}'".format(self.directory, old))
+          total -= entry[1]
+          self.evicted += 1
+          evicted_total.inc()
+          self._remove(old)
+      self._ready.notify_all()
+
+  def get(self):
+    """Wait for the oldest file that is due for upload, and mark it in flight."""
+    with self._ready:
+      while True:
+        now = time.time()
+        due = [path for path, entry in self._files.items()
+               if entry[0] == PENDING and entry[3] <= now]
+        if due:
+          path = due[0]
+          self._files[path][0] = INFLIGHT
+          self._log(path, INFLIGHT)
+          return path
+        retry = [entry[3] for entry in self._files.values() if entry[0] == PENDING]
+        self._ready.wait(min(retry) - now if retry else None)
+
+  def done(self, path):
+    """File has been uploaded: delete it. As the connection evidently works,
+    files waiting to be retried are due right away."""
+    with self._ready:
+      self._remove(path)
+      for entry in self._files.values():
+        entry[2] = 0
+        entry[3] = 0.0
+      self._ready.notify_all()
+
+  def failed(self, path):
+    """File could not be uploaded: retry later, with exponential backoff."""
+    with self._ready:
+      entry = self._files.get(path)
+      if entry is None:
+        return
+      entry[0] = PENDING
+      entry[2] += 1
+      entry[3] = time.time() + min(self.backoff * 2 ** (entry[2] - 1), self.max_backoff)
+      self._log(path, PENDING)
+      logging.info("will retry '{0}' in {1:.0f}s".format(path, entry[3] - time.time()))
+      self._ready.notify_all()
+
+  def _remove(self, path):
+    self._files.pop(path, None)
+    self._log(path, DONE)
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass